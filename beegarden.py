@@ -8,12 +8,61 @@ import random
 
 import time
 import os
+import sys
+import struct
+import threading
+import Queue
+import multiprocessing
+import signal
+import traceback
+import importlib
+import heapq
+import itertools
+import json
+import csv
+import copy
+from array import array
+from collections import OrderedDict, deque
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:  # numpy не обязателен - нужен только для пакетного шага BeeStore
+    numpy = None
 
-SCREENRECT = None
 MAX_LAYERS = 3
-SPRITES_GROUPS = [pygame.sprite.Group() for i in range(MAX_LAYERS + 1)]
 NEAR_RADIUS = 20
+BEE_STATES = ('stop', 'moving', 'loading', 'unloading')
 RANDOM_POINT_BORDER = 42
+SPRITE_IMAGES_CACHE_SIZE = 1024
+REPLAY_MAGIC = 'BEEGARDEN-REPLAY'
+REPLAY_VERSION = 2
+LIVE_SLOTS = 3  # кадров в кольце живого показа: пока один читают, в другие пишут
+LIVE_MAX_SPRITES = 4096
+LIVE_SNAPSHOT_RATE = 120  # сколько раз в секунду симуляция кладет кадр в кольцо
+TELEMETRY_MAGIC = 'BEEGARDEN-TELEMETRY'
+TELEMETRY_VERSION = 1
+TELEMETRY_CHUNK = 4096  # шагов в куске файла телеметрии
+TELEMETRY_QUEUE = 16  # кусков, ждущих записи - дальше симуляция ждет диск
+TELEMETRY_DTYPES = {'I': '<u4', 'f': '<f4'}
+PROFILER_PHASES = ('events', 'tick', 'clear', 'static', 'update', 'draw', 'display', 'wait')
+PROFILER_COUNTED = ('move_at', 'get_nearest_flower')
+PROFILER_WINDOW = 100
+BUDGET_POLICIES = ('skip', 'defer', 'penalize')
+SHARD_MIN_BEES = 20000  # меньше пчел BeeStore двигает сам - пересылка по процессам дороже шага
+SANDBOX_COMMANDS = ('move', 'move_at', 'stop', 'load_honey_from', 'unload_honey_to', 'claim', 'release_claim')
+CONTROL_WAKEUP = USEREVENT + 1  # будильник паузы - проверить очередь команд GameController
+CONTROL_POLL_MS = 100
+# условия GameController.run_until: функция от мира и аргументов команды
+CONTROL_CONDITIONS = {
+    'tick': lambda world, tick: world.ticks >= tick,
+    'hive_honey': lambda world, honey: any(beehive.honey >= honey for beehive in world.beehives),
+    'team_honey': lambda world, team, honey: world.get_score().get(team, 0) >= honey,
+    'flowers_left': lambda world, count: len(world.scene.flowers_with_honey) <= count,
+    'finished': lambda world: world.is_finished(),
+}
+REPLAY_CONDITIONS = ('tick',)  # в повторе и живом показе нет ни сцены, ни ульев - остальные не проверить
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 
 class BaseSprite(pygame.sprite.DirtySprite):
@@ -22,30 +71,43 @@ class BaseSprite(pygame.sprite.DirtySprite):
     _layer = 0
     radius = 1
     speed = 3
-    _sprites_count = 0
+    _index = None
+    _store = None
+    _static = False  # не двигается - рисуется прямо в фон
+    _baked_load = None
+    _image_key = None
+    _drawn_pos = None
+    _flight = 0  # версия полета - для EventScheduler
 
     def __init__(self, pos=None):
         """Создать объект в указанном месте"""
+        self.world = get_world()
 
         if self._layer > MAX_LAYERS:
             self._layer = MAX_LAYERS
         if self._layer < 0:
             self._layer = 0
-        self.containers = self.containers, SPRITES_GROUPS[self._layer]
-        pygame.sprite.Sprite.__init__(self, self.containers)
+        pygame.sprite.DirtySprite.__init__(self, self._get_groups())
 
-        self.image = load_image(self._img_file_name, -1)
-        self.images = [self.image, pygame.transform.flip(self.image, 1, 0)]
-        self.rect = self.image.get_rect()
+        if self.world.headless:  # без экрана картинки не нужны, достаточно размеров
+            self.image = None
+            self.images = None
+            self.rect = Rect((0, 0), get_image_size(self._img_file_name))
+        else:
+            self.images = load_images(self._img_file_name, -1)
+            self.image = self.images[0]
+            self.rect = self.image.get_rect()
 
         if pos is None:
             self.coord = Point(100, 100)
         else:
             self.coord = Point(pos)
-        self.target_coord = Point(0, 0)
-        self.rect.center = self.coord.to_screen()
+        if self.world.events is not None and not self._static:
+            self.coord = _FlightPoint(self, self.coord)
+        self.target_coord = Point.from_xy(0, 0)
+        self.rect.center = self.coord.to_screen(self.world.screenrect.height)
 
-        self.vector = Vector()
+        self.vector = Vector.from_xy(0, 0)
         self.is_moving = False
         self.course = self.vector.angle
         self.shot = False
@@ -53,8 +115,13 @@ class BaseSprite(pygame.sprite.DirtySprite):
         self.load_value = 0
         self.load_value_px = 0
 
-        BaseSprite._sprites_count += 1
-        self._id = BaseSprite._sprites_count
+        self.world.sprites_count += 1
+        self._id = self.world.sprites_count
+        self.world.sprites.append(self)
+        if self.world.profiler is not None:
+            self.world.profiler.watch(self)
+        if self._static:  # шагов у неподвижных нет - за край экрана не пускаем сразу
+            self._keep_on_screen()
 
     def __str__(self):
         return 'sprite %s: %s %s %s %s' % (self._id, self.coord, self.vector, self.is_moving, self.is_turning)
@@ -62,6 +129,19 @@ class BaseSprite(pygame.sprite.DirtySprite):
     def __repr__(self):
         return str(self)
 
+    def _get_groups(self):
+        """Внутренняя, группы мира, в которые попадает спрайт"""
+        groups = [self.world.sprites_groups[self._layer]]
+        if not self._static:  # неподвижным шаги не нужны - мёд за них передает HoneyExchange
+            groups.append(self.world.actors)
+        if self._static and self.world.static is not None:
+            groups.append(self.world.static)
+            self.world.static_changed.add(self)  # еще не нарисован в фоне
+        elif self.world.all is not None:
+            groups.append(self.world.all)
+        return groups
+
+    scene = property(lambda self: self.world.scene, doc="сцена мира, в котором живет объект")
     x = property(lambda self: self.coord.int_x, doc="текущая позиция X объекта")
     y = property(lambda self: self.coord.int_y, doc="текущая позиция Y объекта")
     w = property(lambda self: self.rect.width, doc="ширина спрайта")
@@ -75,39 +155,56 @@ class BaseSprite(pygame.sprite.DirtySprite):
             value = 0
         self.load_value = value
         self.load_value_px = int((value / 100.0) * self.w)
+        if self._static and self.load_value_px != self._baked_load:
+            self.world.static_changed.add(self)
 
     def update(self):
         """Внутренняя функция для обновления переменных отображения"""
-        if self.vector.dx >= 0:
-            self.image = self.images[1].copy()
-        else:
-            self.image = self.images[0].copy()
-        #print self.course, self.vector.angle
+        # картинка меняется только при смене направления или бара загрузки - и берется из кэша
+        key = (self._img_file_name, 1 if self.vector.dx >= 0 else 0, self.load_value_px)
+        if key != self._image_key:
+            self._image_key = key
+            self.image = get_sprite_image(self.images, key)
+            self.dirty = 1
+        if self._store is not None or self.world.events is not None:
+            # координаты двигает хранилище или планировщик событий, прямоугольник - только при отрисовке
+            self.rect.center = self.coord.to_screen(self.world.screenrect.height)
+            self.rect.clamp_ip(self.world.screenrect)
+        if self.rect.topleft != self._drawn_pos:
+            self._drawn_pos = self.rect.topleft
+            self.dirty = 1
+
+    def _tick(self):
+        """Внутренняя функция шага симуляции: перемещение и проверка границ экрана"""
         if self.is_moving:
             self.coord.add(self.vector)
-            self.rect.center = self.coord.to_screen()
+            self.rect.center = self.coord.to_screen(self.world.screenrect.height)
+            if self._index is not None:
+                self._index.move(self)
             if self.near(self.target_coord):
                 self.stop()
-                self.on_stop_at_target()
-
-        if self.load_value_px:
-            pygame.draw.line(self.image, (0, 255, 7), (0, 0), (self.load_value_px, 0), 3)
-
-        if not SCREENRECT.contains(self.rect):
-            if self.rect.top < SCREENRECT.top:
-                self.rect.top = SCREENRECT.top
-            if self.rect.bottom > SCREENRECT.bottom:
-                self.rect.bottom = SCREENRECT.bottom
-            if self.rect.left < SCREENRECT.left:
-                self.rect.left = SCREENRECT.left
-            if self.rect.right > SCREENRECT.right:
-                self.rect.right = SCREENRECT.right
+                self._fire('on_stop_at_target')
+        self._keep_on_screen()
+
+    def _keep_on_screen(self):
+        """Внутренняя, не дать спрайту уйти за край экрана"""
+        screenrect = self.world.screenrect
+        if not screenrect.contains(self.rect):
+            if self.rect.top < screenrect.top:
+                self.rect.top = screenrect.top
+            if self.rect.bottom > screenrect.bottom:
+                self.rect.bottom = screenrect.bottom
+            if self.rect.left < screenrect.left:
+                self.rect.left = screenrect.left
+            if self.rect.right > screenrect.right:
+                self.rect.right = screenrect.right
             self.stop()
 
     def move(self, direction):
         """ Задать движение в направлении <угол в градусах>, <скорость> """
-        self.vector = Vector(direction=direction, module=self.speed)
+        self.vector = Vector.from_polar(direction, self.speed)
         self.is_moving = True
+        self._set_motion()
 
     def move_at(self, target):
         """ Задать движение к указанной точке <объект/точка/координаты>, <скорость> """
@@ -120,17 +217,40 @@ class BaseSprite(pygame.sprite.DirtySprite):
         else:
             raise Exception("move_at: target %s must be coord or point or sprite!" % target)
         self.target_coord = target
-        self.vector = Vector(point1=self.coord, point2=self.target_coord, module=self.speed)
+        self.vector = Vector.from_points(self.coord, self.target_coord, self.speed)
         self.is_moving = True
+        self._set_motion()
 
     def stop(self):
         """ Остановить объект """
         self.is_moving = False
+        self._set_motion()
+
+    def _set_motion(self):
+        """Внутренняя, движение изменилось - сообщить хранилищу numpy или планировщику событий"""
+        if self._store is not None:
+            self._store.set_motion(self)
+        elif self.world.events is not None and not self._static:
+            self.world.events.set_motion(self)
 
     def on_stop_at_target(self):
         """Обработчик события 'остановка у цели' """
         pass
 
+    def _fire(self, handler, *args):
+        """Внутренняя, вызвать обработчик события - через бюджет и профайлер мира, если они включены"""
+        budget = self.world.budget
+        if budget is not None:
+            return budget.call(self, handler, args)
+        return self._call(handler, args)
+
+    def _call(self, handler, args):
+        """Внутренняя, вызвать обработчик события - через профайлер мира, если он включен"""
+        profiler = self.world.profiler
+        if profiler is None:
+            return getattr(self, handler)(*args)
+        return profiler.call(self, handler, args)
+
     def distance_to(self, obj):
         """ Расстояние до объекта <объект/точка>"""
         if isinstance(obj, BaseSprite):
@@ -141,12 +261,16 @@ class BaseSprite(pygame.sprite.DirtySprite):
 
     def near(self, obj, radius=NEAR_RADIUS):
         """ Проверка близости к объекту <объект/точка>"""
-        return self.distance_to(obj) <= radius
+        if isinstance(obj, BaseSprite):
+            obj = obj.coord
+        elif not isinstance(obj, Point):
+            raise Exception("sprite.near: obj %s must be Sprite or Point!" % obj)
+        return self.coord.distance2_to(obj) <= radius * radius
 
 
 class HoneyHolder():
     """Класс объекта, который может нести мёд"""
-    honey_speed = 1
+    honey_speed = property(lambda self: self.world.honey_speed, doc="Сколько мёда передается за шаг")
 
     def __init__(self, honey_loaded, honey_max):
         """Задать начальние значения: honey_loaded - сколько изначально мёда, honey_max - максимум"""
@@ -175,56 +299,69 @@ class HoneyHolder():
         """Загрузить мёд от ... """
         self._state = 'loading'
         self._source = source
+        self.world.honey_exchange.add(self)
 
     def unload_honey_to(self, target):
         """Разгрузить мёд в ... """
         self._target = target
         self._state = 'unloading'
+        self.world.honey_exchange.add(self)
 
     def is_full(self):
         """полностью заполнен?"""
         return self.honey >= self._honey_max
 
     def _update(self):
-        """Внутренняя функция для обновления переменных отображения"""
+        """Внутренняя, передать мёд за шаг и вызвать обработчики, если передача закончилась"""
+        self._finish(*self._transfer())
+
+    def _transfer(self):
+        """Внутренняя, передать мёд за шаг. Возвращает (загрузка закончилась, разгрузка закончилась)"""
         if self._state == 'moving':
             self._source = None
             self._target = None
-            return
+            return False, False
+        loaded = unloaded = False
         if self._source:
             honey = self._source._get_honey()
             if honey:
                 self._put_honey(honey)
                 if self.honey >= self._honey_max:
-                    self.on_honey_loaded()
-                    self._source = None
-                    self._state = 'stop'
+                    loaded = True
                 else:
                     self._state = 'loading'
             else:
-                self.on_honey_loaded()
-                self._source = None
-                self._state = 'stop'
+                loaded = True
         if self._target:
             honey = self._get_honey()
             self._target._put_honey(honey)
             if self.honey == 0:
-                self.on_honey_unloaded()
-                self._target = None
-                self._state = 'stop'
+                unloaded = True
             else:
                 self._state = 'unloading'
+        return loaded, unloaded
+
+    def _finish(self, loaded, unloaded):
+        """Внутренняя, передача закончилась - вызвать обработчики"""
+        if loaded:
+            self._fire('on_honey_loaded')
+            self._source = None
+            self._state = 'stop'
+        if unloaded:
+            self._fire('on_honey_unloaded')
+            self._target = None
+            self._state = 'stop'
 
     def _get_honey(self):
         """Взять мёд у объекта"""
         if self._honey > self.honey_speed:
             self._honey -= self.honey_speed
-            self._set_load_hh()
+            self._honey_changed()
             return self.honey_speed
         elif self._honey > 0:
             value = self._honey
             self._honey = 0
-            self._set_load_hh()
+            self._honey_changed()
             return value
         return 0.0
 
@@ -233,7 +370,11 @@ class HoneyHolder():
         self._honey += value
         if self._honey > self._honey_max:
             self._honey = self._honey_max
-        self._set_load_hh()
+        self._honey_changed()
+
+    def _honey_changed(self):
+        """Внутренняя, мёд поменялся - бар загрузки пересчитается перед отрисовкой"""
+        self.world.honey_exchange.changed.add(self)
 
     def _set_load_hh(self):
         """Внутренняя функция отрисовки бара"""
@@ -241,13 +382,46 @@ class HoneyHolder():
         BaseSprite._set_load(self, load_value)
 
 
+class _StoreField(object):
+    """Поле пчелы, которое при подключенном BeeStore хранится в его массиве"""
+
+    def __init__(self, name, array_name, codes=None):
+        self.name = name
+        self.array_name = array_name
+        self.codes = codes
+
+    def __get__(self, bee, owner):
+        if bee is None:
+            return self
+        store = bee._store
+        if store is None:
+            try:
+                return bee.__dict__[self.name]
+            except KeyError:
+                raise AttributeError(self.name)
+        value = getattr(store, self.array_name)[bee._store_index]
+        if self.codes is not None:
+            return self.codes[value]
+        return value.item()
+
+    def __set__(self, bee, value):
+        store = bee._store
+        if store is None:
+            bee.__dict__[self.name] = value
+        elif self.codes is not None:
+            getattr(store, self.array_name)[bee._store_index] = self.codes.index(value)
+        else:
+            getattr(store, self.array_name)[bee._store_index] = value
+
+
 class Bee(BaseSprite, HoneyHolder):
     """Пчела. Может летать по экрану и носить мёд."""
     _img_file_name = 'bee.png'
     _layer = 2
     team = 1
     my_beehive = None
-    flowers = []
+    _honey = _StoreField('_honey', 'honey')
+    _state = _StoreField('_state', 'state', codes=BEE_STATES)
 
     def __init__(self, pos=None):
         """создать пчелу в указанной точке экрана"""
@@ -256,34 +430,67 @@ class Bee(BaseSprite, HoneyHolder):
         self.my_beehive = Scene.get_beehive(self.team)
         pos = self.my_beehive.coord
         BaseSprite.__init__(self, pos)
-        self.speed = float(self.speed) - random.random()
+        self.speed = float(self.world.speed) - self.world.random.random()
         HoneyHolder.__init__(self, 0, 100)
-        self.on_born()
+        self.world.bees.append(self)
+        if self.scene is not None:
+            self.scene.bees_index.add(self)
+        if self.world.store is not None:
+            self.world.store.add(self)
+        self._fire('on_born')
+
+    flowers = property(lambda self: self.world.flowers, doc="Цветки сцены")
+    flowers_with_honey = property(lambda self: self.scene.flowers_with_honey,
+                                  doc="Цветки с мёдом в порядке создания - живой список сцены, менять нельзя")
 
     def __str__(self):
         return 'bee(%s,%s) %s %s' % (self.x, self.y, self._state, BaseSprite.__str__(self))
 
+    def _get_groups(self):
+        """Внутренняя, пчелы из хранилища numpy шагают в BeeStore.step, а не по одной"""
+        groups = BaseSprite._get_groups(self)
+        if self.world.store is not None:
+            groups.remove(self.world.actors)
+        return groups
+
     def __repr__(self):
         return str(self)
 
-    def update(self):
-        """Внутренняя функция для обновления переменных отображения"""
-        HoneyHolder._update(self)
-        BaseSprite.update(self)
-
     def move_at(self, target):
         """ Задать движение к указанной точке <объект/точка/координаты>, <скорость> """
         self.target = target
         self._state = 'moving'
+        self._source = None
+        self._target = None
+        if self.scene is not None:
+            claimed = self.scene.claims.get_flower(self)
+            if claimed is not None and claimed is not target:
+                self.release_claim()  # полетели не к заявленному цветку - заявка больше не нужна
         BaseSprite.move_at(self, target)
 
+    def claim(self, flower):
+        """Заявить цветок своей целью - другие пчелы увидят это через is_claimed. None - снять заявку"""
+        self.scene.claims.claim(self, flower)
+
+    def release_claim(self):
+        """Снять свою заявку на цветок"""
+        self.scene.claims.release(self)
+
+    claimed_flower = property(lambda self: self.scene.claims.get_flower(self), doc="Заявленный пчелой цветок")
+
+    def is_claimed(self, flower, team=None):
+        """Заявлен ли цветок другими пчелами команды team (по умолчанию - своей)"""
+        if team is None:
+            team = self.team
+        return self.scene.claims.is_claimed(flower, team, exclude=self)
+
     def on_stop_at_target(self):
         """Обработчик события 'остановка у цели' """
         self._state = 'stop'
         if isinstance(self.target, Flower):
-            self.on_stop_at_flower(self.target)
+            self._fire('on_stop_at_flower', self.target)
         elif isinstance(self.target, BeeHive):
-            self.on_stop_at_beehive(self.target)
+            self._fire('on_stop_at_beehive', self.target)
         else:
             pass
 
@@ -303,12 +510,18 @@ class Bee(BaseSprite, HoneyHolder):
 class BeeHive(BaseSprite, HoneyHolder):
     """Улей. Стоит там где поставили и содержит мёд."""
     _img_file_name = 'beehive.png'
+    _static = True
 
     def __init__(self, pos=None, max_honey=4000):
         """создать улей в указанной точке экрана"""
         BaseSprite.__init__(self, pos)
+        self.honey_meter = None
         HoneyHolder.__init__(self, 0, max_honey)
-        self.honey_meter = HoneyMeter(pos=(pos[0] - 24, pos[1] - 37))
+        if not self.world.headless:
+            self.honey_meter = HoneyMeter(pos=(pos[0] - 24, pos[1] - 37))
+            self.honey_meter.set_value(self.honey)
+        if self.scene is not None:
+            self.scene.beehives_index.add(self)
 
     def move(self, direction):
         """Заглушка - улей не может двигаться"""
@@ -318,25 +531,31 @@ class BeeHive(BaseSprite, HoneyHolder):
         """Заглушка - улей не может двигаться"""
         pass
 
-    def update(self):
-        """Внутренняя функция для обновления переменных отображения"""
-        self.honey_meter.set_value(self.honey)
-        HoneyHolder._update(self)
-        BaseSprite.update(self)
+    def _set_load_hh(self):
+        """Внутренняя функция отрисовки бара и счетчика мёда"""
+        HoneyHolder._set_load_hh(self)
+        if self.honey_meter is not None:
+            self.honey_meter.set_value(self.honey)
 
 
 class Flower(BaseSprite, HoneyHolder):
     """Цветок. Источник мёда."""
     _img_file_name = 'romashka.png'
+    _static = True
 
     def __init__(self, pos=None):
         """Создать цветок в указанном месте.
         Если не указано - то в произвольном месте в квадрате ((200,200),(край экрана - 50,край экрана - 50))"""
         if not pos:
-            pos = (random.randint(200, SCREENRECT.width - 50), random.randint(200, SCREENRECT.height - 50))
+            world = get_world()
+            pos = (world.random.randint(200, world.screenrect.width - 50),
+                   world.random.randint(200, world.screenrect.height - 50))
         BaseSprite.__init__(self, pos)
-        honey = random.randint(100, 200)
+        honey = self.world.random.randint(100, 200)
         HoneyHolder.__init__(self, honey, honey)
+        if self.scene is not None:
+            self.scene.flowers_index.add(self)
+            self.scene.flowers_with_honey.append(self)
 
     def move(self, direction):
         """Заглушка - цветок не может двигаться"""
@@ -346,10 +565,18 @@ class Flower(BaseSprite, HoneyHolder):
         """Заглушка - цветок не может двигаться"""
         pass
 
-    def update(self):
-        """Внутренняя функция для обновления переменных отображения"""
-        HoneyHolder._update(self)
-        BaseSprite.update(self)
+    def _get_honey(self):
+        """Взять мёд у цветка. Опустевший цветок убирается из индекса сцены"""
+        honey = HoneyHolder._get_honey(self)
+        self._release_if_empty()
+        return honey
+
+    def _release_if_empty(self):
+        """Внутренняя, опустевший цветок - убрать из индекса сцены и снять заявки на него"""
+        if self._honey <= 0 and self._index is not None:
+            self._index.remove(self)
+            self.scene.flowers_with_honey.remove(self)
+            self.scene.claims.release_flower(self)
 
 
 class Scene:
@@ -357,122 +584,265 @@ class Scene:
     _flower_size = 100
     _behive_size = 50
     _flower_jitter = 0.72
-    beehives = []
+    _behive_margin = (90, 75)  # от края экрана до центра улья
 
     def __init__(self, flowers_count=5, beehives_count=1, speed=5):
-        self._place_flowers(flowers_count)
-        self._place_beehives(beehives_count)
+        """
+        Создать сцену: flowers_count цветков и beehives_count ульев (по одному на команду).
+        Ульи стоят вдоль нижнего края экрана, первые два - в углах, а которые внизу не влезли - вдоль верхнего
+        """
+        if beehives_count < 1:
+            raise Exception("Scene: at least 1 beehive needed, not %s" % beehives_count)
+        self._attach(get_world())
+        beehive_positions = self._get_beehive_positions(beehives_count)
+        hive_rows = 2 if beehive_positions[-1][1] > self._behive_margin[1] else 1
+        self._place_flowers(flowers_count, hive_rows=hive_rows)
+        self._place_beehives(beehive_positions)
         self._set_game_speed(speed)
 
-    def _place_flowers(self, flowers_count):
-        field_width = SCREENRECT.width - self._flower_size * 2
-        field_height = SCREENRECT.height - self._flower_size * 2 - self._behive_size
+    def _attach(self, world):
+        """Внутренняя, стать сценой мира - пока без цветков и ульев"""
+        self.world = world
+        world.scene = self
+        self.flowers = world.flowers
+        self.beehives = world.beehives
+        self.flowers_index = SpatialGrid()  # только цветки с мёдом
+        self.flowers_with_honey = []  # они же в порядке создания - опустевший цветок убирается сам
+        self.claims = ClaimRegistry()  # заявки пчел на цветки
+        self.beehives_index = SpatialGrid()
+        self.bees_index = SpatialGrid()
+
+    @staticmethod
+    def _get_cells(field_width, field_height, flowers_count):
+        """Внутренняя, самая крупная квадратная клетка, которых в поле влезает не меньше flowers_count:
+        (размер, клеток в ширину, клеток в высоту)"""
+        cell_size = int(sqrt(float(field_width * field_height) / flowers_count)) + 1
+        while cell_size > 0:
+            cells_in_width = field_width // cell_size
+            cells_in_height = field_height // cell_size
+            if cells_in_width * cells_in_height >= flowers_count:
+                return cell_size, cells_in_width, cells_in_height
+            cell_size -= 1
+        raise Exception("Too many flowers (%s) for the field %sx%s" % (flowers_count, field_width, field_height))
+
+    def _place_flowers(self, flowers_count, hive_rows=1):
+        """
+        Расставить цветки по клеткам сетки - в случайные клетки, со случайным сдвигом внутри клетки.
+        hive_rows - сколько полос у краев экрана (сверху, а если 2 - и снизу) оставить ульям
+        """
+        screenrect = self.world.screenrect
+        field_width = screenrect.width - self._flower_size * 2
+        field_height = screenrect.height - self._flower_size * 2 - self._behive_size * hive_rows
         if field_width < 100 or field_height < 100:
             raise Exception("Too little field...")
-#        print "field", field_width, field_height
-
-        cell_size = int(round(sqrt(float(field_width * field_height) / flowers_count)))
-        while True:
-            cells_in_width = int(round(field_width / cell_size))
-            cells_in_height = int(round(field_height / cell_size))
-            cells_count = cells_in_width * cells_in_height
-            if cells_count >= flowers_count:
-                break
-            cell_size -= 1
-        cell_numbers = [i for i in range(cells_count)]
-#        print "cells: size", cell_size, "count", cells_count, "in w/h", cells_in_width, cells_in_height
+        if flowers_count < 1:
+            return
 
+        cell_size, cells_in_width, cells_in_height = self._get_cells(field_width, field_height, flowers_count)
         field_width = cells_in_width * cell_size
         field_height = cells_in_height * cell_size
-        x0 = int((SCREENRECT.width - field_width) / 2)
-        y0 = int((SCREENRECT.height - field_height) / 2) + self._behive_size
-#        print "field", field_width, field_height, x0, y0
+        x0 = int((screenrect.width - field_width) / 2)
+        y0 = int((screenrect.height - field_height) / 2)
+        if hive_rows == 1:
+            y0 += self._behive_size
 
+        self.flowers_index.cell_size = cell_size
         min_random = int((1.0 - self._flower_jitter) * (cell_size / 2.0))
         max_random = cell_size - min_random
 
-        self.flowers = []
-        while len(self.flowers) < flowers_count:
-            cell_number = random.choice(cell_numbers)
-            cell_numbers.remove(cell_number)
+        # случайные клетки без повторов - за O(цветков), а не выбором с удалением из списка всех клеток
+        rand = self.world.random
+        cells = rand.sample(xrange(cells_in_width * cells_in_height), flowers_count)
+        for cell_number in cells:
             cell_x = (cell_number % cells_in_width) * cell_size
             cell_y = (cell_number // cells_in_width) * cell_size
-            dx = random.randint(min_random, max_random)
-            dy = random.randint(min_random, max_random)
-            pos = Point(x0 + cell_x + dx, y0 + cell_y + dy)
-            self.flowers.append(Flower(pos))
-        Bee.flowers = self.flowers
+            dx = rand.randint(min_random, max_random)
+            dy = rand.randint(min_random, max_random)
+            self.flowers.append(Flower(Point.from_xy(x0 + cell_x + dx, y0 + cell_y + dy)))
 
-    def _place_beehives(self, beehives_count):
+    def _get_beehive_positions(self, beehives_count):
+        """
+        Внутренняя, где стоят ульи: поровну вдоль нижнего края, первый и второй - в левом и правом углу,
+        остальные между ними. Которые внизу не влезли - так же вдоль верхнего края
+        """
+        width, height = self.world.screenrect.size
+        margin_x, margin_y = self._behive_margin
+        in_row = int((width - 2 * margin_x) // get_image_size(BeeHive._img_file_name)[0]) + 1
+        if beehives_count > in_row * 2:
+            raise Exception("Too many beehives (%s) for the screen width %s" % (beehives_count, width))
+        bottom = min(beehives_count, in_row)
+        if bottom == 1:
+            positions = [(margin_x, margin_y)]
+        else:
+            row = self._get_row(bottom, margin_y)
+            positions = row[:1] + row[-1:] + row[1:-1]
+        return positions + self._get_row(beehives_count - bottom, height - margin_y)
+
+    def _get_row(self, count, y):
+        """Внутренняя, count мест поровну вдоль края экрана на высоте y, слева направо (одно - посередине)"""
+        width = self.world.screenrect.width
+        margin_x = self._behive_margin[0]
+        if count == 1:
+            return [(width // 2, y)]
+        step = (width - 2 * margin_x) / float(count - 1)
+        return [(int(round(margin_x + step * i)), y) for i in range(count)]
+
+    def _place_beehives(self, positions):
         max_honey = 0
         for flower in self.flowers:
             max_honey += flower.honey
-        if beehives_count in (1, 2):
-            if beehives_count == 2:
-                max_honey /= 2.0
-            max_honey = int(round((max_honey / 1000.0) * 1.3)) * 1000
-            if max_honey < 1000:
-                max_honey = 1000
-            Scene.beehives.append(BeeHive(pos=(90, 75), max_honey=max_honey))
-            if beehives_count == 2:
-                self.beehives.append(BeeHive(pos=(SCREENRECT.width - 90, 75), max_honey=max_honey))
-        else:
-            raise Exception("Only 2 beehives!")
+        max_honey /= float(len(positions))
+        max_honey = int(round((max_honey / 1000.0) * 1.3)) * 1000
+        if max_honey < 1000:
+            max_honey = 1000
+        for pos in positions:
+            self.beehives.append(BeeHive(pos=pos, max_honey=max_honey))
 
     @classmethod
     def get_beehive(cls, team):
-        # TODO сделать автоматическое распределение ульев - внизу, по кол-ву команд
+        """Улей команды team (у команды без своего улья - первый)"""
+        beehives = get_world().beehives
         try:
-            return cls.beehives[team - 1]
+            return beehives[team - 1]
         except IndexError:
-            return cls.beehives[0]
+            return beehives[0]
 
     def _set_game_speed(self, speed):
         if speed > NEAR_RADIUS:
             speed = NEAR_RADIUS
-        BaseSprite.speed = speed
+        self.world.speed = speed
         honey_speed = int(speed / 2.0)
         if honey_speed < 1:
             honey_speed = 1
-        HoneyHolder.honey_speed = honey_speed
+        self.world.honey_speed = honey_speed
+
+
+_images = {}
+
+
+def _get_display_depth():
+    """Глубина цвета экрана или None, если экрана нет (например, в безэкранном режиме)"""
+    if not pygame.display.get_init():
+        return None
+    screen = pygame.display.get_surface()
+    if screen is None:
+        return None
+    return screen.get_bitsize()
 
 
 def load_image(name, colorkey=None):
-    """Загрузить изображение из файла"""
-    fullname = os.path.join('data', name)
+    """
+    Загрузить изображение из файла. Каждый файл читается с диска один раз на процесс -
+    картинка общая, рисовать на ней нельзя. Если уже есть экран - картинка переводится в его формат
+    """
+    depth = _get_display_depth()
+    key = (name, colorkey, depth)
+    if key in _images:
+        return _images[key]
+    fullname = os.path.join(DATA_DIR, name)
     try:
         image = pygame.image.load(fullname)
     except pygame.error, message:
         print "Cannot load image:", name
         raise SystemExit(message)
-        #image = image.convert()
+    if depth is not None:
+        if not image.get_flags() & SRCALPHA:
+            image = image.convert()
+        elif depth >= 24:  # на палитровом экране (например, у драйвера dummy) convert_alpha портит прозрачность
+            image = image.convert_alpha()
     if colorkey is not None:
         if colorkey is -1:
             colorkey = image.get_at((0, 0))
         image.set_colorkey(colorkey, RLEACCEL)
+    _images[key] = image
+    return image
+
+
+def load_images(name, colorkey=None):
+    """Картинка из файла и ее отражение по горизонтали - общие для всех спрайтов"""
+    key = ('flipped', name, colorkey, _get_display_depth())
+    if key not in _images:
+        image = load_image(name, colorkey)
+        _images[key] = [image, pygame.transform.flip(image, 1, 0)]
+    return _images[key]
+
+
+def preload_images(colorkey=-1):
+    """Загрузить заранее все картинки из каталога data - чтобы рождение спрайтов не ходило на диск"""
+    for name in sorted(os.listdir(DATA_DIR)):
+        if os.path.splitext(name)[1].lower() in ('.png', '.bmp', '.jpg', '.gif'):
+            load_images(name, colorkey)
+
+
+_sprite_images = OrderedDict()
+
+
+def get_sprite_image(images, key):
+    """
+    Картинка спрайта (файл, направление, бар загрузки в пикселах) из общего LRU-кэша.
+    Картинки из кэша общие для всех спрайтов - рисовать на них нельзя
+    """
+    image = _sprite_images.pop(key, None)
+    if image is None:
+        name, facing, load_value_px = key
+        image = images[facing]
+        if load_value_px:
+            image = image.copy()
+            pygame.draw.line(image, (0, 255, 7), (0, 0), (load_value_px, 0), 3)
+    _sprite_images[key] = image
+    if len(_sprite_images) > SPRITE_IMAGES_CACHE_SIZE:
+        _sprite_images.popitem(last=False)
     return image
 
 
-class Point():
+def get_image_size(name):
+    """Размеры изображения из файла - для безэкранного режима"""
+    return load_image(name).get_size()
+
+
+class Point(object):
     """Класс точки на экране"""
+    __slots__ = ('x', 'y')
 
     int_x = property(lambda self: round(self.x), doc="Округленная до пиксела координата X")
     int_y = property(lambda self: round(self.y), doc="Округленная до пиксела координата Y")
 
     def __init__(self, arg1=0, arg2=0):
         """Создать точку. Можно создать из другой точки, из списка/тьюпла или из конкретных координат"""
-        try:  # arg1 is Point
-            self.x = arg1.x
-            self.y = arg1.y
-        except AttributeError:
-            try:  # arg1 is tuple or list
-                self.x, self.y = arg1
-            except:  # arg1 & arg2 is numeric
-                self.x, self.y = arg1, arg2
-
-    def to_screen(self):
-        """Преобразовать координаты к экранным"""
-        return self.int_x, SCREENRECT.height - self.int_y
+        arg_type = type(arg1)
+        if arg_type is int or arg_type is float:  # самый частый случай - числа
+            self.x, self.y = arg1, arg2
+        elif arg_type is tuple or arg_type is list:
+            self.x, self.y = arg1
+        else:
+            try:  # arg1 is Point (или что-то с x и y)
+                self.x = arg1.x
+                self.y = arg1.y
+            except AttributeError:
+                try:  # arg1 is sequence
+                    self.x, self.y = arg1
+                except (TypeError, ValueError):  # arg1 & arg2 is numeric
+                    self.x, self.y = arg1, arg2
+
+    @classmethod
+    def from_xy(cls, x, y):
+        """Быстрое создание точки по координатам - без разбора аргументов"""
+        point = cls.__new__(cls)
+        point.x = x
+        point.y = y
+        return point
+
+    def __getstate__(self):
+        return self.x, self.y
+
+    def __setstate__(self, state):
+        self.x, self.y = state
+
+    def to_screen(self, screen_height=None):
+        """Преобразовать координаты к экранным. screen_height - высота экрана мира точки, по умолчанию - текущего"""
+        if screen_height is None:
+            screen_height = get_world().screenrect.height
+        return self.int_x, screen_height - self.int_y
 
     def add(self, vector):
         """Прибавить вектор - точка смещается на вектор"""
@@ -481,24 +851,44 @@ class Point():
 
     def sub(self, vector):
         """Вычесть вектор - точка смещается на "минус" вектор"""
-        self.add(-vector)
+        self.x -= vector.dx
+        self.y -= vector.dy
+
+    def __iadd__(self, vector):
+        self.add(vector)
+        return self
+
+    def __isub__(self, vector):
+        self.sub(vector)
+        return self
 
     def distance_to(self, point2):
         """Расстояние до другой точки"""
-        return sqrt(pow(self.x - point2.x, 2) + pow(self.y - point2.y, 2))
+        dx = self.x - point2.x
+        dy = self.y - point2.y
+        return sqrt(dx * dx + dy * dy)
+
+    def distance2_to(self, point2):
+        """Квадрат расстояния до другой точки - для сравнений расстояний корень не нужен"""
+        dx = self.x - point2.x
+        dy = self.y - point2.y
+        return dx * dx + dy * dy
 
     def near(self, point2, radius=NEAR_RADIUS):
         """Признак расположения рядом с другой точкой, рядом - это значит ближе, чем радиус"""
-        return self.distance_to(point2) < radius
+        return self.distance2_to(point2) < radius * radius
 
     def __eq__(self, point2):
         """Сравнение двух точек на равенство целочисленных координат"""
-        #~ if point2:
-            #~ print self, point2
         if self.int_x == point2.int_x and self.int_y == point2.int_y:
             return True
         return False
 
+    def __ne__(self, point2):
+        return not self == point2
+
+    __hash__ = object.__hash__
+
     def __str__(self):
         """Преобразование к строке"""
         return 'point(%s,%s)' % (self.x, self.y)
@@ -522,46 +912,121 @@ class Point():
         return 0
 
 
-class Vector():
-    """Класс математического вектора"""
+class Vector(object):
+    """
+    Класс математического вектора. Модуль и угол считаются только когда их спросят
+    (и запоминаются до изменения вектора его методами)
+    """
+    __slots__ = ('dx', 'dy', '_module', '_angle')
 
     def __init__(self, point1=None, point2=None, direction=None, module=None, dx=None, dy=None):
         """
         Создать вектор. Можно создать из двух точек (длинной в модуль, если указан),
-        а можно указать направление и модуль вектора.
+        а можно указать направление и модуль вектора, или сразу dx и dy.
         """
         self.dx = 0
         self.dy = 0
+        self._module = None
+        self._angle = None
 
-        if dx and dy:
-            self.dx, self.dy = dx, dy
-        elif point1 or point2:  # если заданы точки
-            if not point1:
+        if dx is not None or dy is not None:
+            self.dx, self.dy = dx or 0, dy or 0
+        elif point1 is not None or point2 is not None:  # если заданы точки
+            if point1 is None:
                 point1 = Point(0, 0)
-            if not point2:
+            if point2 is None:
                 point2 = Point(0, 0)
             self.dx = float(point2.x - point1.x)
             self.dy = float(point2.y - point1.y)
-        elif direction:  # ... или задано направление
+        elif direction is not None:  # ... или задано направление
             direction = (direction * pi) / 180
             self.dx = sin(direction)
             self.dy = cos(direction)
 
-        self.module = self._determine_module()
         if module:  # если задана длина вектора, то ограничиваем себя :)
-            if self.module:
-                self.dx *= module / self.module
-                self.dy *= module / self.module
-            self.module = module
+            self._set_module(module)
 
-        self.angle = self._determine_angle()
+    @classmethod
+    def from_xy(cls, dx, dy):
+        """Быстрое создание вектора по смещениям"""
+        vector = cls.__new__(cls)
+        vector.dx = dx
+        vector.dy = dy
+        vector._module = None
+        vector._angle = None
+        return vector
+
+    @classmethod
+    def from_points(cls, point1, point2, module=None):
+        """Быстрое создание вектора от точки point1 к точке point2 (длиной module, если указан)"""
+        vector = cls.from_xy(float(point2.x - point1.x), float(point2.y - point1.y))
+        if module:
+            vector._set_module(module)
+        return vector
+
+    @classmethod
+    def from_polar(cls, direction, module=None):
+        """Быстрое создание вектора по направлению <угол в градусах> (и модулю, если указан)"""
+        direction = (direction * pi) / 180
+        vector = cls.from_xy(sin(direction), cos(direction))
+        if module:
+            vector._set_module(module)
+        return vector
+
+    def _set_module(self, module):
+        """Внутренняя, растянуть вектор до длины module"""
+        current = sqrt(self.dx * self.dx + self.dy * self.dy)
+        if current:
+            self.dx *= module / current
+            self.dy *= module / current
+        self._module = module
+        self._angle = None
+
+    def _changed(self):
+        """Внутренняя, вектор изменился - модуль и угол надо пересчитать"""
+        self._module = None
+        self._angle = None
+
+    def _get_module(self):
+        if self._module is None:
+            self._module = sqrt(self.dx * self.dx + self.dy * self.dy)
+        return self._module
+
+    def _get_angle(self):
+        if self._angle is None:
+            self._angle = self._determine_angle()
+        return self._angle
+
+    module = property(_get_module, _set_module, doc="Длина вектора")
+    angle = property(_get_angle, doc="Направление вектора в градусах")
+
+    def __getstate__(self):
+        return self.dx, self.dy, self._module, self._angle
+
+    def __setstate__(self, state):
+        self.dx, self.dy, self._module, self._angle = state
 
     def add(self, vector2):
         """Сложение векторов"""
         self.dx += vector2.dx
         self.dy += vector2.dy
-        self.module = self._determine_module()
-        self.angle = self._determine_angle()
+        self._changed()
+
+    def __iadd__(self, vector2):
+        self.add(vector2)
+        return self
+
+    def __isub__(self, vector2):
+        self.dx -= vector2.dx
+        self.dy -= vector2.dy
+        self._changed()
+        return self
+
+    def __imul__(self, factor):
+        self.dx *= factor
+        self.dy *= factor
+        self._changed()
+        return self
 
     def _determine_module(self):
         return sqrt(self.dx * self.dx + self.dy * self.dy)
@@ -591,107 +1056,2607 @@ class Vector():
         return int(self.module)
 
     def __neg__(self):
-        return Vector(dx=-self.dx, dy=-self.dy)
+        return Vector.from_xy(-self.dx, -self.dy)
+
+
+class SpatialGrid:
+    """
+    Равномерная сетка для быстрого поиска объектов (спрайтов) рядом с точкой.
+    Расстояния сравниваются в квадратах, без извлечения корня.
+    """
+
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._keys = {}
+        self._min_key = None
+        self._max_key = None
+        # вызывается перед каждым запросом - так BeeStore обновляет ячейки пчел лениво
+        self.before_query = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, obj):
+        return obj in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def _key(self, point):
+        return int(point.x // self.cell_size), int(point.y // self.cell_size)
+
+    def add(self, obj):
+        """Добавить объект в индекс"""
+        if obj in self._keys:
+            return
+        key = self._key(obj.coord)
+        self._cells.setdefault(key, set()).add(obj)
+        self._keys[obj] = key
+        obj._index = self
+        if self._min_key is None:
+            self._min_key, self._max_key = key, key
+        else:
+            self._min_key = (min(self._min_key[0], key[0]), min(self._min_key[1], key[1]))
+            self._max_key = (max(self._max_key[0], key[0]), max(self._max_key[1], key[1]))
+
+    def remove(self, obj):
+        """Убрать объект из индекса"""
+        key = self._keys.pop(obj, None)
+        if key is None:
+            return
+        cell = self._cells[key]
+        cell.remove(obj)
+        if not cell:
+            del self._cells[key]
+        obj._index = None
+
+    def move(self, obj):
+        """Объект сместился - перенести его в нужную ячейку"""
+        key = self._key(obj.coord)
+        if self._keys.get(obj) != key:
+            self.remove(obj)
+            self.add(obj)
+
+    def _ring(self, center, radius):
+        """Ячейки на расстоянии radius ячеек от центральной"""
+        cx, cy = center
+        if radius == 0:
+            cell = self._cells.get(center)
+            if cell:
+                yield cell
+            return
+        for i in range(-radius, radius + 1):
+            for key in ((cx + i, cy - radius), (cx + i, cy + radius)):
+                cell = self._cells.get(key)
+                if cell:
+                    yield cell
+        for j in range(-radius + 1, radius):
+            for key in ((cx - radius, cy + j), (cx + radius, cy + j)):
+                cell = self._cells.get(key)
+                if cell:
+                    yield cell
+
+    def _max_ring(self, center):
+        """Сколько колец ячеек нужно обойти, чтобы покрыть все занятые ячейки"""
+        return max(abs(center[0] - self._min_key[0]), abs(center[0] - self._max_key[0]),
+                   abs(center[1] - self._min_key[1]), abs(center[1] - self._max_key[1]))
+
+    def k_nearest(self, point, k, predicate=None, max_distance=None):
+        """
+        k ближайших к точке объектов, для которых predicate(obj) истинно (если задан),
+        не дальше max_distance (если задано). Список отсортирован по удалению.
+        """
+        if self.before_query is not None:
+            self.before_query()
+        if not self._keys or k <= 0:
+            return []
+        x, y = point.x, point.y
+        max_d2 = None if max_distance is None else max_distance * max_distance
+        center = self._key(point)
+        found = []
+        for radius in range(self._max_ring(center) + 1):
+            # все ещё не просмотренные объекты дальше, чем (radius - 1) ячеек
+            bound = (radius - 1) * self.cell_size
+            if radius and len(found) >= k and found[k - 1][0] <= bound * bound:
+                break
+            if max_d2 is not None and radius > 1 and bound * bound > max_d2:
+                break
+            for cell in self._ring(center, radius):
+                for obj in cell:
+                    d2 = (obj.coord.x - x) ** 2 + (obj.coord.y - y) ** 2
+                    if max_d2 is not None and d2 > max_d2:
+                        continue
+                    if predicate is not None and not predicate(obj):
+                        continue
+                    found.append((d2, obj._id, obj))
+            found.sort()
+            del found[k:]
+        return [obj for d2, _id, obj in found]
+
+    def nearest(self, point, predicate=None, max_distance=None):
+        """Ближайший к точке объект (с учетом predicate и max_distance) или None"""
+        found = self.k_nearest(point, 1, predicate=predicate, max_distance=max_distance)
+        if found:
+            return found[0]
+        return None
+
+    def in_radius(self, point, radius, predicate=None):
+        """Все объекты не дальше radius от точки, отсортированные по удалению"""
+        if self.before_query is not None:
+            self.before_query()
+        if not self._keys:
+            return []
+        x, y = point.x, point.y
+        r2 = radius * radius
+        x0, y0 = self._key(Point.from_xy(x - radius, y - radius))
+        x1, y1 = self._key(Point.from_xy(x + radius, y + radius))
+        found = []
+        for cx in range(max(x0, self._min_key[0]), min(x1, self._max_key[0]) + 1):
+            for cy in range(max(y0, self._min_key[1]), min(y1, self._max_key[1]) + 1):
+                for obj in self._cells.get((cx, cy), ()):
+                    d2 = (obj.coord.x - x) ** 2 + (obj.coord.y - y) ** 2
+                    if d2 > r2:
+                        continue
+                    if predicate is not None and not predicate(obj):
+                        continue
+                    found.append((d2, obj._id, obj))
+        found.sort()
+        return [obj for d2, _id, obj in found]
+
+
+class ClaimRegistry:
+    """Заявки пчел на цветки: какие пчелы каких команд выбрали цветок своей целью"""
+    # у пчелы одна заявка: новая заменяет старую, а полет к другой цели или пустой цветок ее снимает
+
+    def __init__(self):
+        self._flowers = {}  # цветок -> {команда: множество пчел}
+        self._bees = {}  # пчела -> цветок
+
+    def claim(self, bee, flower):
+        """Заявить цветок целью пчелы (None - просто снять заявку)"""
+        if self._bees.get(bee) is flower:
+            return
+        self.release(bee)
+        if flower is None:
+            return
+        self._flowers.setdefault(flower, {}).setdefault(bee.team, set()).add(bee)
+        self._bees[bee] = flower
+
+    def release(self, bee):
+        """Снять заявку пчелы"""
+        flower = self._bees.pop(bee, None)
+        if flower is None:
+            return
+        teams = self._flowers[flower]
+        bees = teams[bee.team]
+        bees.discard(bee)
+        if not bees:
+            del teams[bee.team]
+            if not teams:
+                del self._flowers[flower]
+
+    def release_flower(self, flower):
+        """Снять все заявки на цветок"""
+        for bees in self._flowers.pop(flower, {}).values():
+            for bee in bees:
+                del self._bees[bee]
+
+    def get_flower(self, bee):
+        """Цветок, заявленный пчелой, или None"""
+        return self._bees.get(bee)
+
+    def claimants(self, flower, team=None):
+        """Пчелы (команды team, если задана), заявившие цветок - в порядке создания"""
+        teams = self._flowers.get(flower)
+        if not teams:
+            return []
+        if team is not None:
+            bees = teams.get(team, ())
+        else:
+            bees = [bee for team_bees in teams.values() for bee in team_bees]
+        return sorted(bees, key=lambda bee: bee._id)
+
+    def is_claimed(self, flower, team=None, exclude=None):
+        """Заявлен ли цветок (пчелами команды team, если задана), не считая пчелы exclude"""
+        teams = self._flowers.get(flower)
+        if not teams:
+            return False
+        for bees in (teams.values() if team is None else (teams.get(team, ()),)):
+            if len(bees) > 1 or (bees and exclude not in bees):
+                return True
+        return False
+
+
+class _StorePoint(Point):
+    """Координаты пчелы - вид на строку массива координат BeeStore"""
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def _get_x(self):
+        return self._store.pos[self._index, 0].item()
+
+    def _set_x(self, value):
+        self._store.pos[self._index, 0] = value
+
+    def _get_y(self):
+        return self._store.pos[self._index, 1].item()
+
+    def _set_y(self, value):
+        self._store.pos[self._index, 1] = value
+
+    x = property(_get_x, _set_x)
+    y = property(_get_y, _set_y)
+
+    def __getstate__(self):
+        return self._store, self._index
+
+    def __setstate__(self, state):
+        self._store, self._index = state
+
+    def add(self, vector):
+        """Прибавить вектор - точка смещается на вектор"""
+        self._store.pos[self._index] += (vector.dx, vector.dy)
+
+
+class BeeStore:
+    """Состояние пчел в массивах numpy: пчелы - виды на строки массивов, а движение - один пакетный шаг"""
+    # с shards > 1 массивы лежат в общей памяти и процессы двигают каждый свой отрезок,
+    # а обработчики прилетов вызываются здесь, в порядке создания пчел
+    _arrays = (  # имя, столбцов, тип
+        ('pos', 2, 'f8'),
+        ('vel', 2, 'f8'),
+        ('target', 2, 'f8'),
+        ('size', 2, 'i4'),
+        ('cells', 2, 'i8'),
+        ('honey', 1, 'f8'),
+        ('state', 1, 'i1'),
+        ('moving', 1, '?'),
+    )
+
+    def __init__(self, world, capacity=1024, shards=1):
+        if numpy is None:
+            raise Exception("BeeStore: numpy is required!")
+        self.world = world
+        self.count = 0
+        self.bees = []
+        self.index = None
+        self.shards = shards
+        self._shared = None  # имя -> RawArray, если массивы в общей памяти
+        self._workers = []  # (процесс, канал) шага по процессам
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        """Внутренняя, выделить массивы нужного размера, сохранив данные"""
+        self.close()  # процессы видят старые массивы - запустятся заново на новых
+        shared = {} if self.shards > 1 else None
+        for name, width, dtype in self._arrays:
+            if shared is None:
+                array = numpy.zeros((capacity, width) if width > 1 else capacity, dtype=dtype)
+            else:
+                shared[name] = multiprocessing.RawArray('b', capacity * width * numpy.dtype(dtype).itemsize)
+                array = _shared_array(shared[name], capacity, width, dtype)
+            if self.count:
+                array[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, array)
+        self._shared = shared
+        self.capacity = capacity
+
+    def add(self, bee):
+        """Подключить пчелу к хранилищу - дальше ее состояние живет в массивах"""
+        if self.count == self.capacity:
+            self._allocate(self.capacity * 2)
+        i = self.count
+        self.pos[i] = (bee.coord.x, bee.coord.y)
+        self.size[i] = bee.rect.size
+        self.honey[i] = bee.__dict__.pop('_honey')
+        self.state[i] = BEE_STATES.index(bee.__dict__.pop('_state'))
+        self.bees.append(bee)
+        self.count += 1
+        bee._store_index = i
+        bee._store = self
+        bee.coord = _StorePoint(self, i)
+        self.set_motion(bee)
+        if bee._index is not None:
+            self.index = bee._index
+            self.index.before_query = self._sync_index
+            self.cells[i] = bee._index._key(bee.coord)
+        return i
+
+    def _sync_index(self):
+        """Перенести в индексе сцены пчел, сменивших ячейку - делается только перед запросом к индексу"""
+        n = self.count
+        cells = numpy.floor_divide(self.pos[:n], self.index.cell_size).astype(numpy.int64)
+        changed = (cells != self.cells[:n]).any(axis=1)
+        if changed.any():
+            self.cells[:n] = cells
+            for i in numpy.flatnonzero(changed):
+                self.index.move(self.bees[i])
+
+    def set_motion(self, bee):
+        """Записать в массивы движение пчелы (после move/move_at/stop)"""
+        i = bee._store_index
+        self.vel[i] = (bee.vector.dx, bee.vector.dy)
+        self.target[i] = (bee.target_coord.x, bee.target_coord.y)
+        self.moving[i] = bee.is_moving
+
+    def step(self):
+        """Шаг движения всех пчел хранилища (мёд до этого передал HoneyExchange)"""
+        n = self.count
+        if not n:
+            return
+        if self.shards > 1 and n >= SHARD_MIN_BEES:
+            arrived, off_screen = self._step_shards(n)
+        else:
+            arrived, off_screen = _move_bees(self.pos, self.vel, self.target, self.size, self.moving,
+                                             self.world.screenrect, 0, n)
+        arrived, off_screen = set(arrived.tolist()), set(off_screen.tolist())
+        for i in sorted(arrived | off_screen):
+            bee = self.bees[i]
+            if i in arrived:
+                bee.stop()
+                bee._fire('on_stop_at_target')
+            if i in off_screen:
+                bee.rect.center = bee.coord.to_screen(self.world.screenrect.height)
+                bee._keep_on_screen()
+
+    def _step_shards(self, n):
+        """Внутренняя, шаг движения по процессам: (прилетевшие, вышедшие за край) - номера пчел"""
+        if not self._workers:
+            self._start()
+        bounds = [n * shard // self.shards for shard in range(self.shards + 1)]
+        for (process, connection), lo, hi in zip(self._workers, bounds, bounds[1:]):
+            connection.send((lo, hi))
+        try:
+            results = [connection.recv() for process, connection in self._workers]
+        except (IOError, EOFError):
+            self.close()
+            raise Exception("BeeStore: shard process died")
+        return numpy.concatenate([result[0] for result in results]), \
+            numpy.concatenate([result[1] for result in results])
+
+    def _start(self):
+        """Внутренняя, запустить процессы шага на текущих массивах"""
+        for shard in range(self.shards):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_main, args=(child, self._shared, self.capacity,
+                                                                        Rect(self.world.screenrect)))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._workers.append((process, connection))
+
+    def close(self):
+        """Остановить процессы шага"""
+        for process, connection in self._workers:
+            _stop_process(process)
+            connection.close()
+        self._workers = []
+
+
+def _shared_array(raw, capacity, width, dtype):
+    """Массив numpy поверх общей памяти RawArray"""
+    array = numpy.frombuffer(raw, dtype=dtype)
+    return array.reshape((capacity, width)) if width > 1 else array
+
+
+def _move_bees(pos, vel, target, size, moving, screenrect, lo, hi):
+    """
+    Сдвинуть летящих пчел lo..hi-1 массивов BeeStore на их скорость.
+    Возвращает номера прилетевших к цели и вышедших за край экрана (как в BaseSprite._keep_on_screen)
+    """
+    moving = moving[lo:hi]
+    pos = pos[lo:hi]
+    pos[moving] += vel[lo:hi][moving]
+
+    delta = pos - target[lo:hi]
+    arrived = moving & ((delta * delta).sum(axis=1) <= NEAR_RADIUS * NEAR_RADIUS)
+    x, y = pos[:, 0], pos[:, 1]
+    size = size[lo:hi]
+    # округление как у round() - от нуля
+    center_x = numpy.sign(x) * numpy.floor(numpy.abs(x) + 0.5)
+    center_y = screenrect.height - numpy.sign(y) * numpy.floor(numpy.abs(y) + 0.5)
+    left = center_x - size[:, 0] // 2
+    top = center_y - size[:, 1] // 2
+    off_screen = moving & ((left < screenrect.left) | (top < screenrect.top) |
+                           (left + size[:, 0] > screenrect.right) | (top + size[:, 1] > screenrect.bottom))
+    return numpy.flatnonzero(arrived) + lo, numpy.flatnonzero(off_screen) + lo
+
+
+def _shard_main(connection, shared, capacity, screenrect):
+    """Процесс шага BeeStore: двигает пчел присланного отрезка общих массивов"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # см. _sandbox_main
+    arrays = dict((name, _shared_array(shared[name], capacity, width, dtype))
+                  for name, width, dtype in BeeStore._arrays)
+    while True:
+        try:
+            lo, hi = connection.recv()
+        except EOFError:
+            return
+        connection.send(_move_bees(arrays['pos'], arrays['vel'], arrays['target'], arrays['size'],
+                                   arrays['moving'], screenrect, lo, hi))
+
+
+class _FlightPoint(Point):
+    """
+    Координаты подвижного спрайта в режиме событий (EventScheduler): в полете точка не двигается по шагам,
+    а считается по формуле - начало полета + число сделанных шагов * вектор
+    """
+    __slots__ = ('_sprite', '_x', '_y', '_t0', '_dx', '_dy')
+
+    def __init__(self, sprite, point):
+        self._sprite = sprite
+        self._x, self._y = point.x, point.y
+        self._t0 = None  # шаг начала полета, None - стоит на месте
+        self._dx = self._dy = 0.0
+
+    def _get_x(self):
+        if self._t0 is None:
+            return self._x
+        return self._x + (self._sprite.world.events.steps(self._sprite) - self._t0) * self._dx
+
+    def _get_y(self):
+        if self._t0 is None:
+            return self._y
+        return self._y + (self._sprite.world.events.steps(self._sprite) - self._t0) * self._dy
+
+    def _rebase(self):
+        """Внутренняя, начать полет заново из текущей точки - перед тем как ее менять"""
+        if self._t0 is not None:
+            self._x, self._y, self._t0 = self.x, self.y, self._sprite.world.events.steps(self._sprite)
+
+    def _set_x(self, value):
+        self._rebase()
+        self._x = value
+
+    def _set_y(self, value):
+        self._rebase()
+        self._y = value
+
+    x = property(_get_x, _set_x)
+    y = property(_get_y, _set_y)
+
+    def __getstate__(self):
+        return self._sprite, self._x, self._y, self._t0, self._dx, self._dy
+
+    def __setstate__(self, state):
+        self._sprite, self._x, self._y, self._t0, self._dx, self._dy = state
+
+    def add(self, vector):
+        """Прибавить вектор - точка смещается на вектор"""
+        self._rebase()
+        self._x += vector.dx
+        self._y += vector.dy
+
+
+class HoneyExchange:
+    """Передача мёда в мире - отдельная фаза в начале шага, до движения"""
+    # сначала мёд передают все, и только потом в порядке создания вызываются on_honey_loaded/unloaded
+    LOADING, UNLOADING = BEE_STATES.index('loading'), BEE_STATES.index('unloading')
+
+    def __init__(self, world):
+        self.world = world
+        self.active = {}  # номер -> объект, который грузится или разгружается
+        self.changed = set()  # у кого поменялся мёд с прошлой отрисовки
+
+    def __len__(self):
+        return len(self.active)
+
+    def add(self, holder):
+        """Объект начал грузиться или разгружаться"""
+        self.active[holder._id] = holder
+
+    def step(self):
+        """Передать мёд за шаг"""
+        if not self.active:
+            return
+        holders = [self.active[key] for key in sorted(self.active)]
+        results = None
+        if self.world.store is not None:
+            results = self._transfer_numpy(holders)
+        if results is None:
+            results = [holder._transfer() for holder in holders]
+        for holder, (loaded, unloaded) in zip(holders, results):
+            if loaded or unloaded:
+                holder._finish(loaded, unloaded)
+            if not (holder._state in ('loading', 'unloading') or holder._source or holder._target):
+                self.active.pop(holder._id, None)
+
+    def _transfer_numpy(self, holders):
+        """
+        Внутренняя, _transfer для всех сразу - если все они пчелы BeeStore, которые грузятся из объектов
+        вне хранилища или разгружаются в них. Иначе None - тогда по одному
+        """
+        store = self.world.store
+        loading, unloading = [], []
+        for position, holder in enumerate(holders):
+            if holder._store is not store:
+                return None
+            if holder._state == 'moving':  # улетел - передача прервана
+                holder._source = holder._target = None
+                continue
+            source, target = holder._source, holder._target
+            if source and not target and source._store is None:
+                loading.append(position)
+            elif target and not source and target._store is None:
+                unloading.append(position)
+            else:
+                return None
+        results = [(False, False)] * len(holders)
+        speed = self.world.honey_speed
+        if loading:
+            bees = [holders[position] for position in loading]
+            rows = numpy.array([bee._store_index for bee in bees])
+            sources, groups = self._group([bee._source for bee in bees])
+            honey = numpy.array([source._honey for source in sources], dtype=numpy.float64)
+            # место пчелы в очереди к своему цветку: пчелы уже идут в порядке создания
+            counts = numpy.bincount(groups)
+            order = numpy.argsort(groups, kind='mergesort')
+            rank = numpy.empty(len(groups), dtype=numpy.int64)
+            rank[order] = numpy.arange(len(groups)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            taken = numpy.clip(honey[groups] - rank * speed, 0, speed)
+            honey_max = numpy.array([bee._honey_max for bee in bees], dtype=numpy.float64)
+            store.honey[rows] = numpy.minimum(store.honey[rows] + taken, honey_max)
+            loaded = (taken == 0) | (store.honey[rows] >= honey_max)
+            store.state[rows[~loaded]] = self.LOADING
+            for source, value in zip(sources, numpy.maximum(honey - counts * speed, 0).tolist()):
+                if value != source._honey:
+                    source._honey = value
+                    source._honey_changed()
+                    if isinstance(source, Flower):
+                        source._release_if_empty()
+            self.changed.update(bees)
+            for position, done in zip(loading, loaded.tolist()):
+                results[position] = (done, False)
+        if unloading:
+            bees = [holders[position] for position in unloading]
+            rows = numpy.array([bee._store_index for bee in bees])
+            targets, groups = self._group([bee._target for bee in bees])
+            given = numpy.minimum(store.honey[rows], speed)
+            store.honey[rows] -= given
+            for target, value in zip(targets, numpy.bincount(groups, weights=given).tolist()):
+                target._put_honey(value)
+            unloaded = store.honey[rows] == 0
+            store.state[rows[~unloaded]] = self.UNLOADING
+            self.changed.update(bees)
+            for position, done in zip(unloading, unloaded.tolist()):
+                results[position] = (False, done)
+        return results
+
+    @staticmethod
+    def _group(objects):
+        """Внутренняя, (разные объекты в порядке появления, номер группы каждого объекта - массив numpy)"""
+        numbers = {}
+        unique = []
+        groups = []
+        for obj in objects:
+            number = numbers.get(obj)
+            if number is None:
+                number = numbers[obj] = len(unique)
+                unique.append(obj)
+            groups.append(number)
+        return unique, numpy.array(groups, dtype=numpy.int64)
+
+    def update_loads(self):
+        """Пересчитать бары загрузки у тех, чей мёд поменялся - перед отрисовкой"""
+        for holder in self.changed:
+            holder._set_load_hh()
+        self.changed.clear()
+
+
+class EventScheduler:
+    """Планировщик событий мира: прилеты считаются заранее, и мир перепрыгивает к ближайшему событию"""
+    # шаг прилета считается при каждом move/move_at/stop, а пока кто-то передает мёд, мир идет по шагам.
+    # С одним зерном игра повторяется, но от пошаговой может отличаться в последних знаках координат
+
+    def __init__(self, world):
+        self.world = world
+        self._heap = []  # (шаг, номер спрайта, порядковый номер, спрайт, версия полета)
+        self._sequence = itertools.count()
+        self._current = None  # номер спрайта, событие полета которого обрабатывается сейчас
+        self._flying = set()
+        self._index = None
+
+    def _first_tick(self, sprite):
+        """Ближайший шаг, в котором спрайт еще сделает шаг движения"""
+        tick = self.world.ticks + 1
+        if self._current is not None and sprite._id <= self._current:
+            tick += 1
+        return tick
+
+    def steps(self, sprite):
+        """Сколько шагов движения спрайт уже сделал к этому моменту"""
+        return self._first_tick(sprite) - 1
+
+    def set_motion(self, sprite):
+        """Движение спрайта изменилось (после move/move_at/stop) - запланировать его следующее событие"""
+        point = sprite.coord
+        now = self.steps(sprite)
+        if point._t0 is not None:
+            point._x, point._y, point._t0 = point.x, point.y, None
+        self._flying.discard(sprite)
+        sprite._flight += 1  # старые события полета больше не действуют
+        if not sprite.is_moving:
+            return
+        point._t0, point._dx, point._dy = now, sprite.vector.dx, sprite.vector.dy
+        self._flying.add(sprite)
+        if sprite._index is not None and sprite._index.before_query is None:
+            self._index = sprite._index
+            self._index.before_query = self._sync_index
+        self._plan(sprite, now, 1)
+
+    def wake(self, sprite):
+        """Не пропускать следующий шаг спрайта - например, чтобы вызвать отложенный обработчик"""
+        heapq.heappush(self._heap, (self._first_tick(sprite), 0, next(self._sequence), None, None))
+
+    def _plan(self, sprite, t0, k_min):
+        """Запланировать ближайший, не раньше k_min шагов полета, прилет к цели или выход за край экрана"""
+        point = sprite.coord
+        x0, y0, dx, dy = point._x, point._y, point._dx, point._dy
+        k = self._arrival_steps(sprite, x0, y0, dx, dy, k_min)
+        exit_k = self._exit_steps(sprite, x0, y0, dx, dy, k_min, k)
+        if exit_k is not None and (k is None or exit_k < k):
+            k = exit_k
+        if k is not None:
+            heapq.heappush(self._heap, (t0 + k, sprite._id, next(self._sequence), sprite, sprite._flight))
+
+    def _arrival_steps(self, sprite, x0, y0, dx, dy, k_min):
+        """Через сколько шагов (не меньше k_min) спрайт будет рядом с целью - как в BaseSprite.near"""
+        target = sprite.target_coord
+        tx, ty = target.x, target.y
+        radius2 = NEAR_RADIUS * NEAR_RADIUS
+
+        def near(k):
+            ex, ey = x0 + k * dx - tx, y0 + k * dy - ty
+            return ex * ex + ey * ey <= radius2
+
+        # |(x0, y0) + k * (dx, dy) - цель|^2 <= R^2 - квадратное неравенство по k
+        a = dx * dx + dy * dy
+        ex, ey = x0 - tx, y0 - ty
+        b = 2 * (ex * dx + ey * dy)
+        c = ex * ex + ey * ey - radius2
+        if a == 0:
+            return k_min if c <= 0 else None
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            return None
+        root = sqrt(discriminant)
+        k_last = (-b + root) / (2 * a)
+        k = max(k_min, int(ceil((-b - root) / (2 * a))))
+        # корни посчитаны в плавающей точке - уточняем той же формулой, что и координаты
+        while k > k_min and near(k - 1):
+            k -= 1
+        while not near(k):
+            if k > k_last + 1:
+                return None
+            k += 1
+        return k
+
+    def _exit_steps(self, sprite, x0, y0, dx, dy, k_min, k_max):
+        """Через сколько шагов (не меньше k_min) прямоугольник спрайта выйдет за край экрана - как в _keep_on_screen"""
+        screenrect = self.world.screenrect
+        w, h = sprite.rect.size
+        rect = Rect(0, 0, w, h)
+
+        def off(k):
+            x, y = x0 + k * dx, y0 + k * dy
+            rect.center = round(x), screenrect.height - round(y)
+            return not screenrect.contains(rect)
+
+        if off(k_min):
+            return k_min
+        # пересечение центром линии в полспрайта от края - дальше уточняется той же проверкой
+        crossings = []
+        if dx > 0:
+            crossings.append((screenrect.right - w / 2.0 - x0) / dx)
+        elif dx < 0:
+            crossings.append((screenrect.left + w / 2.0 - x0) / dx)
+        if dy > 0:
+            crossings.append((screenrect.height - screenrect.top - h / 2.0 - y0) / dy)
+        elif dy < 0:
+            crossings.append((screenrect.height - screenrect.bottom + h / 2.0 - y0) / dy)
+        if not crossings:
+            return None
+        k = max(k_min, int(floor(min(crossings))) - 1)
+        if k_max is not None and k > k_max:
+            return None  # к цели прилетит раньше
+        while not off(k):
+            k += 1
+            if k_max is not None and k > k_max:
+                return None
+        while k > k_min and off(k - 1):
+            k -= 1
+        return k
+
+    def _sync_index(self):
+        """Перенести в индексе сцены летящих спрайтов - делается только перед запросом к индексу"""
+        for sprite in self._flying:
+            if sprite._index is self._index:
+                self._index.move(sprite)
+
+    def next_tick(self):
+        """Шаг ближайшего события или None, если больше ничего не случится"""
+        if self.world.honey_exchange:  # кто-то передает мёд - следующий шаг нужен
+            return self.world.ticks + 1
+        heap = self._heap
+        while heap:
+            tick, _id, sequence, sprite, version = heap[0]
+            if sprite is not None and version != sprite._flight:
+                heapq.heappop(heap)  # полет поменялся - событие устарело
+                continue
+            return tick
+        return None
+
+    def run_tick(self, tick):
+        """Выполнить шаг tick: передать мёд и обработать события полета (шаги до него пропускаются)"""
+        world = self.world
+        world.ticks = tick - 1
+        world.honey_exchange.step()
+        heap = self._heap
+        try:
+            while heap and heap[0][0] <= tick:
+                event_tick, _id, sequence, sprite, version = heapq.heappop(heap)
+                self._current = _id
+                if sprite is not None and version == sprite._flight:
+                    self._arrive(sprite, tick)
+        finally:
+            self._current = None
+        world.ticks = tick
+
+    def _arrive(self, sprite, tick):
+        """Событие полета: проверки те же, что в BaseSprite._tick"""
+        version = sprite._flight
+        sprite.rect.center = sprite.coord.to_screen(sprite.world.screenrect.height)
+        if sprite._index is not None:
+            sprite._index.move(sprite)
+        if sprite.near(sprite.target_coord):
+            sprite.stop()
+            sprite._fire('on_stop_at_target')
+        sprite._keep_on_screen()
+        if sprite.is_moving and sprite._flight == version:
+            # ни прилета, ни края (цель сама сдвинулась) - ищем следующее событие этого же полета
+            point = sprite.coord
+            self._plan(sprite, point._t0, tick - point._t0 + 1)
+
+
+_current = threading.local()
+
+
+def get_world():
+    """Текущий мир этого потока"""
+    world = getattr(_current, 'world', None)
+    if world is None:
+        raise Exception("No world! Create GameEngine or World first")
+    return world
+
+
+class World:
+    """Мир одной игры: экран, группы спрайтов, сцена, ульи, цветки и пчелы"""
+    # спрайты попадают в текущий мир своего потока (get_world)
+
+    def __init__(self, resolution=(1024, 768), headless=False, use_numpy=False, seed=None, event_driven=False,
+                 shards=1):
+        """seed - зерно случайных чисел (с ним игра повторяется), event_driven - см. EventScheduler,
+        shards - на сколько процессов делить пакетный шаг огромного роя (нужен use_numpy)"""
+        if use_numpy and event_driven:
+            raise Exception("World: use_numpy and event_driven can't be used together")
+        if shards > 1 and not use_numpy:
+            raise Exception("World: shards need use_numpy")
+        self.screenrect = Rect((0, 0), resolution)
+        self.headless = headless
+        self.sprites_groups = [pygame.sprite.Group() for i in range(MAX_LAYERS + 1)]
+        # спрайты в порядке создания - в нем и считаем шаги симуляции
+        self.actors = pygame.sprite.OrderedUpdates()
+        self.all = None  # группа отрисовки, ее заводит GameEngine
+        self.static = None  # неподвижные спрайты, нарисованные в фоне
+        self.static_changed = set()  # те из них, у которых бар в фоне устарел
+        self.scene = None
+        self.beehives = []
+        self.flowers = []
+        self.bees = []
+        self.sprites = []  # все спрайты мира в порядке создания
+        self.sprites_count = 0
+        self.ticks = 0
+        self.fork_depth = 0  # 0 - настоящий мир, у копии fork - на 1 больше, чем у мира, с которого ее сняли
+        self.speed = BaseSprite.speed
+        self.honey_speed = 1
+        self.store = BeeStore(self, shards=shards) if use_numpy else None
+        self.events = EventScheduler(self) if event_driven else None
+        self.honey_exchange = HoneyExchange(self)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.on_tick = []  # вызываются после каждого шага симуляции
+        self.profiler = None  # Profiler, если включен
+        self.budget = None  # CallbackBudget, если включен
+        self._previous = []
+
+    def activate(self):
+        """Сделать мир текущим для этого потока"""
+        _current.world = self
+
+    def __enter__(self):
+        self._previous.append(getattr(_current, 'world', None))
+        self.activate()
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.world = self._previous.pop()
+
+    def tick(self):
+        """Один шаг симуляции всех объектов"""
+        with self:  # в потоке может быть и другой мир - код пчел и случайные числа должны видеть этот
+            if self.events is not None:
+                self.events.run_tick(self.ticks + 1)
+            else:
+                self.honey_exchange.step()
+                for sprite in self.actors.sprites():
+                    sprite._tick()
+                if self.store is not None:
+                    self.store.step()
+                self.ticks += 1
+            for callback in self.on_tick:
+                callback()
+
+    def advance(self, max_tick=None):
+        """Перейти к ближайшему шагу с событием, но не дальше max_tick (без планировщика - один шаг).
+        False - событий до max_tick нет"""
+        if self.events is None:
+            if max_tick is not None and self.ticks >= max_tick:
+                return False
+            self.tick()
+            return True
+        with self:
+            tick = self._pass_quiet_ticks(max_tick)
+            if tick is None:
+                if max_tick is not None:
+                    self.ticks = max(self.ticks, max_tick)
+                return False
+            self.events.run_tick(tick)
+            for callback in self.on_tick:
+                callback()
+        return True
+
+    def _pass_quiet_ticks(self, max_tick):
+        """Внутренняя, шаг ближайшего события не дальше max_tick (None - его нет).
+        Шаги без событий до него проходятся только ради on_tick"""
+        # точки в полете считаются по формуле от world.ticks, так что записи видят их и на этих шагах
+        while True:
+            tick = self.events.next_tick()
+            if tick is not None and max_tick is not None and tick > max_tick:
+                tick = None
+            last = max_tick if tick is None else tick - 1
+            if not self.on_tick or last is None or self.ticks >= last:
+                return tick
+            self.ticks += 1
+            for callback in self.on_tick:  # могут и поменять движение - тогда событие пересчитается
+                callback()
+
+    def close(self):
+        """Остановить процессы шага пчел, если они запущены"""
+        if self.store is not None:
+            self.store.close()
+
+    def is_finished(self):
+        """Игра закончена: мёда в цветках нет и пчелы больше ничего не несут в улей"""
+        if self.scene.flowers_index:
+            return False
+        for bee in self.bees:
+            if bee._state == 'unloading' or (bee.is_moving and bee.honey > 0):
+                return False
+        return True
+
+    def get_score(self):
+        """Мёд в ульях по командам: {команда: мёд}"""
+        return dict((team, beehive.honey) for team, beehive in enumerate(self.beehives, 1))
+
+    def snapshot(self):
+        """Снимок состояния мира - к нему можно вернуться через restore (см. WorldSnapshot)"""
+        return WorldSnapshot(self)
+
+    def restore(self, snapshot):
+        """Вернуть мир к снимку, сделанному snapshot"""
+        snapshot.restore(self)
+
+    def fork(self, n_ticks=0):
+        """Независимая копия мира без экрана на n_ticks шагов вперед (спрайты - в ее sprites в том же порядке).
+        Копия вызывает код пчел, поэтому ее fork_depth на 1 больше: пчелы в копии не должны форкать снова"""
+        # картинки, группы отрисовки, профайлер, бюджет и on_tick в копию не попадают
+        memo = {id(self.on_tick): [], id(self._previous): [], id(self.profiler): None, id(self.budget): None}
+        if self.store is not None:  # копия шагает в одном процессе
+            memo[id(self.store._shared)] = None
+            memo[id(self.store._workers)] = []
+        for group in (self.all, self.static):
+            if group is not None:
+                memo[id(group)] = None
+        memo[id(self.static_changed)] = set()
+        for sprite in self.sprites:
+            memo[id(sprite.image)] = None
+            memo[id(sprite.images)] = None
+            if sprite.images is not None:
+                for image in sprite.images:
+                    memo[id(image)] = None
+            honey_meter = getattr(sprite, 'honey_meter', None)
+            if honey_meter is not None:
+                memo[id(honey_meter)] = None
+        world = copy.deepcopy(self, memo)
+        world.headless = True
+        world.fork_depth = self.fork_depth + 1
+        if world.store is not None:
+            world.store.shards = 1
+        for sprite in world.sprites:
+            sprite._Sprite__g.pop(None, None)  # выброшенные группы отрисовки
+            for name, value in sprite.__dict__.items():
+                if getattr(value, '_engine_wrapper', False):  # обертки методов профайлера и песочницы
+                    del sprite.__dict__[name]
+        if n_ticks:
+            max_tick = world.ticks + n_ticks
+            with world:
+                while world.advance(max_tick):
+                    pass
+        return world
+
+
+class WorldSnapshot:
+    """Снимок состояния мира (World.snapshot). Вернуть можно только мир без новых спрайтов после снимка"""
+    # поля кода пчел копируются поверхностно - список, измененный на месте, вернется измененным
+    _store_arrays = ('pos', 'vel', 'target', 'cells', 'honey', 'state', 'moving')
+
+    def __init__(self, world):
+        self.ticks = world.ticks
+        self.random_state = world.random.getstate()
+        self.speed = world.speed
+        self.honey_speed = world.honey_speed
+        self.sprites = [self._save_sprite(sprite) for sprite in world.sprites]
+        self.store = None
+        if world.store is not None:
+            count = world.store.count
+            self.store = dict((name, getattr(world.store, name)[:count].copy()) for name in self._store_arrays)
+        self.events = None
+        if world.events is not None:
+            self.events = (list(world.events._heap), set(world.events._flying))
+        self.honey_exchange = dict(world.honey_exchange.active)
+        self.flowers = list(world.flowers)  # список виден пчелам, и код пчел может его менять
+        self.claims = None
+        self.flowers_with_honey = None
+        if world.scene is not None:
+            self.claims = world.scene.claims._bees.items()
+            self.flowers_with_honey = set(world.scene.flowers_index)
+
+    @staticmethod
+    def _save_sprite(sprite):
+        """Внутренняя, (поля, координаты) спрайта"""
+        state = sprite.__dict__.copy()
+        state['rect'] = Rect(sprite.rect)
+        state['vector'] = copy.copy(sprite.vector)
+        coord = sprite.coord
+        if isinstance(coord, _StorePoint):
+            coord_state = None  # координаты - в массивах хранилища
+        elif isinstance(coord, _FlightPoint):
+            coord_state = coord.__getstate__()
+        else:
+            coord_state = coord.x, coord.y
+        return state, coord_state
+
+    def restore(self, world):
+        """Вернуть мир к снимку"""
+        if len(world.sprites) != len(self.sprites):
+            raise Exception("WorldSnapshot: %d sprites were created after the snapshot"
+                            % (len(world.sprites) - len(self.sprites)))
+        world.ticks = self.ticks
+        world.random.setstate(self.random_state)
+        world.speed = self.speed
+        world.honey_speed = self.honey_speed
+        for sprite, (state, coord_state) in zip(world.sprites, self.sprites):
+            sprite.__dict__.clear()
+            sprite.__dict__.update(state)
+            sprite.rect = Rect(state['rect'])
+            sprite.vector = copy.copy(state['vector'])
+            if coord_state is not None:
+                sprite.coord.__setstate__(coord_state)
+            sprite._drawn_pos = sprite._baked_load = None  # на экране мир еще в другом месте - перерисовать
+            sprite.dirty = 1
+            if sprite._static and world.static is not None:
+                world.static_changed.add(sprite)
+        if self.store is not None:
+            count = world.store.count
+            for name, values in self.store.items():
+                getattr(world.store, name)[:count] = values
+        if self.events is not None:
+            heap, flying = self.events
+            world.events._heap = list(heap)
+            world.events._flying = set(flying)
+        world.flowers[:] = self.flowers
+        exchange = world.honey_exchange
+        exchange.active = dict(self.honey_exchange)
+        exchange.changed.update(sprite for sprite in world.sprites if isinstance(sprite, HoneyHolder))
+        scene = world.scene
+        if scene is not None:
+            flowers = [sprite for sprite in world.sprites if isinstance(sprite, Flower)]
+            for flower in flowers:
+                if flower in self.flowers_with_honey:
+                    scene.flowers_index.add(flower)
+                else:
+                    scene.flowers_index.remove(flower)
+            scene.flowers_with_honey[:] = [flower for flower in flowers if flower in self.flowers_with_honey]
+            for bee in world.bees:
+                if bee._index is not None:
+                    bee._index.move(bee)
+            scene.claims.__init__()
+            for bee, flower in self.claims:
+                scene.claims.claim(bee, flower)
 
 
 class GameEngine:
     """Игровой движок. Выполняет все функции по отображению спрайтов и взаимодействия с пользователем"""
 
-    def __init__(self, name, background_color=None, max_fps=60, resolution=None):
-        """Создать игру. """
-        global SCREENRECT
-
-        pygame.init()
+    def __init__(self, name, background_color=None, max_fps=60, resolution=None, headless=False, use_numpy=False,
+                 seed=None, ticks_per_frame=1, tick_rate=None, max_ticks_per_frame=None, interpolate=False,
+                 profile=False, event_driven=False, shards=1):
+        """Создать игру. headless - без экрана и ограничения FPS, use_numpy, seed, event_driven, shards - см. World,
+        profile - сразу включить профайлер (в игре он включается клавишей P)"""
+        if ticks_per_frame < 1:
+            raise Exception("GameEngine: ticks_per_frame must be 1 or more, not %s" % ticks_per_frame)
+        if interpolate and not tick_rate:
+            raise Exception("GameEngine: interpolate needs tick_rate - without it frames would lag a tick behind")
         if background_color is None:
             background_color = (87, 144, 40)
         if resolution is None:
             resolution = (1024, 768)
-        SCREENRECT = Rect((0, 0), resolution)
-        self.screen = pygame.display.set_mode(SCREENRECT.size)
+        self.world = World(resolution=resolution, headless=headless, use_numpy=use_numpy, seed=seed,
+                           event_driven=event_driven, shards=shards)
+        self.world.activate()
+        self.headless = headless
+        self.debug = False  # на паузе - шаги по одному, по команде
+        self.halt = False
+        self.controller = GameController(self)
+        # шаг симуляции фиксированный, кадров на него может приходиться сколько угодно:
+        # ticks_per_frame шагов на каждый кадр или tick_rate шагов в секунду реального времени -
+        # тогда скорость игры не зависит от того, сколько кадров успевает машина
+        self.ticks_per_frame = ticks_per_frame
+        self.tick_rate = tick_rate
+        # сколько шагов за кадр можно сделать, догоняя время (по умолчанию - на 1/4 секунды),
+        # если не успеваем и так - игра замедляется
+        if max_ticks_per_frame is None:
+            max_ticks_per_frame = int(ceil(tick_rate / 4.0)) if tick_rate else ticks_per_frame
+        self.max_ticks_per_frame = max_ticks_per_frame
+        self.interpolate = interpolate  # рисовать подвижные спрайты между двумя последними шагами (при tick_rate)
+        self._tick_lag = 0.0  # сколько шагов (с дробной частью) задолжали реальному времени
+        self._previous_positions = []
+        if profile:
+            Profiler(self.world)
+        self.profiler_overlay = None
+
+        if self.headless:
+            self.fps_meter = None
+            return
+
+        pygame.init()
+        self.screen = pygame.display.set_mode(self.world.screenrect.size)
         pygame.display.set_caption(name)
 
         self.background = pygame.Surface(self.screen.get_size())  # и ее размер
         self.background = self.background.convert()
         self.background.fill(background_color)  # заполняем цветом
+        self.clean_background = self.background.copy()  # фон без цветков и ульев
         self.screen.blit(self.background, (0, 0))
         pygame.display.flip()
+        preload_images()
 
-        self.all = pygame.sprite.LayeredUpdates()
-        BaseSprite.containers = self.all
-        Fps.containers = self.all
-        HoneyMeter.containers = self.all
+        # перерисовываются только спрайты с флагом dirty (сдвинулись или сменили картинку)
+        self.all = self.world.all = pygame.sprite.LayeredDirty()
+        self.static = self.world.static = pygame.sprite.OrderedUpdates()
+        self._static_rects = ([], [])  # неподвижные спрайты и их прямоугольники - для поиска перекрытий
 
-        global clock
-        clock = pygame.time.Clock()
-        self.fps_meter = Fps(color=(255, 255, 0))
+        self.clock = pygame.time.Clock()
+        self.fps_meter = Fps(self.clock, color=(255, 255, 0))
         self.max_fps = max_fps
 
-        self.debug = False
+    ticks = property(lambda self: self.world.ticks, doc="сколько шагов симуляции прошло")
+    profiler = property(lambda self: self.world.profiler, doc="профайлер мира, None - если выключен")
+
+    def _lap(self, phase):
+        """Внутренняя, отметить для профайлера конец фазы кадра. None - время с прошлой отметки не считать"""
+        if self.world.profiler is not None:
+            self.world.profiler.lap(phase)
+
+    def toggle_profiler(self):
+        """Показать/спрятать профайлер. При первом показе он включается"""
+        if self.world.profiler is None:
+            Profiler(self.world)
+        if self.profiler_overlay is None:
+            self.profiler_overlay = ProfilerOverlay(self.world.profiler)
+        self.profiler_overlay.show = not self.profiler_overlay.show
+
+    def _tick(self):
+        """Один шаг симуляции всех объектов"""
+        self.world.tick()
+
+    def _redraw_static(self):
+        """Внутренняя, перерисовать в фоне цветки и ульи, у которых поменялся бар загрузки"""
+        # на экран область переносит LayeredDirty вместе с пролетающими над ней пчелами
+        changed = [sprite for sprite in self.world.static_changed if sprite._baked_load != sprite.load_value_px]
+        self.world.static_changed.clear()
+        if not changed:
+            return
+        for sprite in changed:
+            sprite.update()
+            sprite._baked_load = sprite.load_value_px
+        statics, rects = self._static_rects
+        if len(statics) != len(self.static):  # неподвижные не двигаются - пересчитываем, только если их стало больше
+            statics = self.static.sprites()
+            rects = [sprite.rect for sprite in statics]
+            self._static_rects = (statics, rects)
+        for sprite in changed:
+            area = sprite.rect
+            self.background.set_clip(area)
+            self.background.blit(self.clean_background, area, area)
+            for i in area.collidelistall(rects):
+                self.background.blit(statics[i].image, statics[i].rect)
+            self.background.set_clip(None)
+            self.all.repaint_rect(area)
+
+    def _frame_ticks(self):
+        """Сколько шагов симуляции сделать в этом кадре"""
+        if self.debug:  # по шагам
+            return 1
+        if self.tick_rate is None:
+            return self.ticks_per_frame
+        self._tick_lag += self.clock.get_time() / 1000.0 * self.tick_rate
+        ticks = min(int(self._tick_lag), self.max_ticks_per_frame)
+        self._tick_lag -= ticks
+        if self._tick_lag >= 1:  # не догнали - долг прощаем, иначе он будет только расти
+            self._tick_lag %= 1
+        return ticks
+
+    def _step_frame(self, step):
+        """Сделать шаги симуляции одного кадра. Перед последним запоминаем позиции - для интерполяции"""
+        ticks = self._frame_ticks()
+        for i in range(ticks):
+            if self.interpolate and i == ticks - 1:
+                self._previous_positions = [(sprite, sprite.coord.x, sprite.coord.y)
+                                            for sprite in self.world.sprites if not sprite._static]
+            if step() is False:  # запись или чужая игра кончилась - дальше шагов не будет
+                self.controller._stop()
+                break
+            if not self.controller.after_tick():
+                break
+
+    def _interpolate_positions(self):
+        """
+        Сдвинуть подвижные спрайты между предыдущим и текущим шагом на долю шага, которую задолжали времени.
+        Возвращает настоящие позиции - их надо вернуть после отрисовки
+        """
+        alpha = self._tick_lag
+        screenrect = self.world.screenrect
+        moved = []
+        for sprite, x, y in self._previous_positions:
+            coord = sprite.coord
+            if coord.x == x and coord.y == y:
+                continue
+            moved.append((sprite, sprite.rect.topleft))
+            point = Point.from_xy(x + (coord.x - x) * alpha, y + (coord.y - y) * alpha)
+            sprite.rect.center = point.to_screen(screenrect.height)
+            sprite.rect.clamp_ip(screenrect)
+            if sprite.rect.topleft != sprite._drawn_pos:
+                sprite._drawn_pos = sprite.rect.topleft
+                sprite.dirty = 1
+        return moved
 
     def _draw_scene(self):
-        # TODO ускорить через начальную отрисовку всех цветков и ульев в бакграунд
+        self._step_frame(self._tick)
+        self._lap('tick')
+        self._render()
+
+    def _render(self):
+        """Отрисовать кадр"""
         # clear/erase the last drawn sprites
         self.all.clear(self.screen, self.background)
+        self._lap('clear')
         #update all the sprites
+        self.world.honey_exchange.update_loads()
+        self._redraw_static()
+        self._lap('static')
         self.all.update()
+        moved = self._interpolate_positions() if self.interpolate and not self.debug else ()
+        self._lap('update')
         #draw the scene
         dirty = self.all.draw(self.screen)
+        for sprite, topleft in moved:
+            sprite.rect.topleft = topleft
+        self._lap('draw')
         pygame.display.update(dirty)
+        self._lap('display')
         #cap the framerate
-        clock.tick(self.max_fps)
+        self.clock.tick(self.max_fps)
+        self._lap('wait')
+        if self.world.profiler is not None:
+            self.world.profiler.end_frame()
+
+    def simulate(self, max_ticks=None):
+        """Крутить симуляцию без отрисовки, пока не кончится мёд в цветках или не пройдет max_ticks шагов.
+        Возвращает мёд в ульях по командам"""
+        profiler = self.world.profiler
+        self._lap(None)
+        max_tick = None if max_ticks is None else self.world.ticks + max_ticks
+        while not self.world.is_finished():
+            if not self.world.advance(max_tick):
+                break
+            if profiler is not None:  # без экрана кадр - это один шаг (или прыжок к событию)
+                profiler.lap('tick')
+                profiler.end_frame()
+        return self.world.get_score()
+
+    def go(self, debug=False, max_ticks=None):
+        """Играть, пока не закроют окно (или не придет команда quit).
+        debug - начать на паузе, дальше шаги клавишей S или командами controller"""
+        if self.headless and not debug:
+            return self.simulate(max_ticks=max_ticks)
+        self.debug = debug
+        self.halt = False
+        max_tick = None if max_ticks is None else self.world.ticks + max_ticks
+        self._lap(None)
+        if self.debug and not self.headless:
+            self._draw_scene()
+        with self.world, self.controller:  # играть можно и в своем потоке, управляя из другого
+            while self.controller.poll():
+                if not self.headless:
+                    self._draw_scene()
+                elif self.world.is_finished() or not self.world.advance(max_tick):
+                    self.controller._stop()  # дальше идти некуда - ждем команд
+                else:
+                    self.controller.after_tick()
+
+    def record_replay(self, file_name):
+        """Записывать игру в файл повтора (см. ReplayRecorder). Возвращает записывающий объект - его надо закрыть"""
+        return ReplayRecorder(self.world, file_name)
+
+    def play_replay(self, file_name, debug=False):
+        """Показать записанную игру - без логики пчел, только по записанным координатам и мёду"""
+        player = ReplayPlayer(file_name)
+        if player.resolution != self.world.screenrect.size:
+            raise Exception("play_replay: replay resolution %s differs from the game's %s" % (
+                player.resolution, self.world.screenrect.size))
+        self.debug = debug
+        self.halt = False
+        self._lap(None)
+        self.controller.replay = True
+        with self.controller:
+            while self.controller.poll():
+                self._step_frame(player.step)
+                self._lap('tick')
+                self._render()
+        player.close()
+
+    def watch(self, setup, args=(), debug=False, keep_open=True, **options):
+        """Показывать игру, которую setup(*args) создает без экрана в отдельном процессе (см. LiveSimulation).
+        keep_open=False - вернуться, как только игра кончилась. Возвращает LiveSimulation с итогом"""
+        live = LiveSimulation(setup, args, **options)
+        self.debug = debug
+        self.halt = False
+        self._lap(None)
+        self.controller.replay = True
+        try:
+            with self.controller:
+                while self.controller.poll():
+                    self._step_frame(live.step)
+                    self._lap('tick')
+                    self._render()
+                    if live.shown and not keep_open:
+                        break
+        finally:
+            live.close()
+        return live
+
+
+class GameController:
+    """Управление игрой: клавиши и команды из кода (скрипта, теста, другого потока) - через одну очередь"""
+    # команды выполняются по очереди, pause прерывает текущую; на паузе процесс спит в ожидании
+
+    def __init__(self, game):
+        self.game = game
+        self.commands = Queue.Queue()
+        self.idle = threading.Event()  # на паузе и все команды выполнены
+        self.steps = 0  # сколько шагов сделать, прежде чем снова встать на паузу
+        self.until = None  # (условие, аргументы) - run_until
+        self.replay = False  # показываем повтор или чужую игру - условия только из REPLAY_CONDITIONS
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    paused = property(lambda self: self.game.debug, doc="игра на паузе")
+
+    def __enter__(self):
+        if not self.game.headless:
+            pygame.time.set_timer(CONTROL_WAKEUP, CONTROL_POLL_MS)
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.game.headless:
+            pygame.time.set_timer(CONTROL_WAKEUP, 0)
+        self.replay = False
+        self.idle.set()
+
+    def _send(self, *command):
+        with self._lock:
+            self.idle.clear()
+            self.commands.put(command)
+
+    def pause(self):
+        """Встать на паузу, прервав step и run_until"""
+        self._send('pause')
+
+    def resume(self):
+        """Играть дальше без остановок"""
+        self._send('resume')
+
+    def step(self, ticks=1):
+        """Сделать ticks шагов (по кадру на шаг) и встать на паузу"""
+        if ticks < 1:
+            raise Exception("GameController: ticks must be 1 or more, not %s" % ticks)
+        self._send('step', ticks)
+
+    def run_until(self, condition, *args):
+        """Играть, пока не выполнится условие: имя из CONTROL_CONDITIONS или функция (мир, *args)"""
+        if not callable(condition) and condition not in CONTROL_CONDITIONS:
+            raise Exception("GameController: unknown condition %s" % condition)
+        self._check_replay_condition(condition)
+        self._send('until', condition, args)
+
+    def quit(self):
+        """Закончить игру"""
+        self._send('quit')
+
+    def wait_idle(self, timeout=None):
+        """Дождаться (из другого потока), пока игра выполнит все команды и встанет на паузу. False - не дождались"""
+        return self.idle.wait(timeout)
+
+    def _stop(self):
+        """Внутренняя, встать на паузу, бросив step и run_until"""
+        self.game.debug = True
+        self.steps = 0
+        self.until = None
+
+    def _busy(self):
+        return self.steps or self.until is not None
+
+    def _check_replay_condition(self, condition):
+        """Внутренняя, можно ли проверить условие run_until в повторе"""
+        if self.replay and not callable(condition) and condition not in REPLAY_CONDITIONS:
+            raise Exception("GameController: condition %s can't be checked in a replay, use %s or a function" % (
+                condition, ', '.join(REPLAY_CONDITIONS)))
+
+    def _apply(self, command):
+        """Внутренняя, выполнить команду"""
+        game = self.game
+        name = command[0]
+        if name == 'quit':
+            game.halt = True
+        elif name == 'pause':
+            self._stop()
+        elif name == 'resume':
+            self._stop()
+            game.debug = False
+        elif name == 'step':
+            game.debug = True
+            self.steps += command[1]
+        elif name == 'until':
+            condition, args = command[1:]
+            self._check_replay_condition(condition)  # команду могли послать до начала повтора
+            if not callable(condition):
+                condition = CONTROL_CONDITIONS[condition]
+            game.debug = False
+            self.until = condition, args
+
+    def _run_commands(self):
+        """Внутренняя, забрать команды из очереди и выполнить те, до которых дошла очередь"""
+        while True:
+            try:
+                self._pending.append(self.commands.get_nowait())
+            except Queue.Empty:
+                break
+        while self._pending:
+            if self._busy():
+                urgent = [command for command in self._pending if command[0] in ('pause', 'quit')]
+                if not urgent:
+                    break
+                command = urgent[0]
+                self._pending.remove(command)
+            else:
+                command = self._pending.popleft()
+            self._apply(command)
 
-    def _proceed_keyboard(self):
-        one_step = False
-        for event in pygame.event.get():
+    def _handle_events(self, events):
+        """Внутренняя, клавиши и окно"""
+        game = self.game
+        for event in events:
             if (event.type == QUIT) or (event.type == KEYDOWN and event.key == K_ESCAPE):
-                self.halt = True
+                game.halt = True
             if event.type == KEYDOWN and event.key == K_f:
-                self.fps_meter.show = not self.fps_meter.show
+                game.fps_meter.show = not game.fps_meter.show
             if event.type == KEYDOWN and event.key == K_d:
-                self.debug = not self.debug
+                if game.debug:
+                    self._apply(('resume',))
+                else:
+                    self._stop()
             if event.type == KEYDOWN and event.key == K_s:
-                one_step = True
-        if self.debug and not one_step:
+                self._apply(('step', 1))
+            if event.type == KEYDOWN and event.key == K_p:
+                game.toggle_profiler()
+
+    def poll(self):
+        """
+        Обработать клавиши и команды. На паузе без дел - спать, пока не придет клавиша или команда.
+        Возвращает True, если пора делать кадр, False - игра закончена
+        """
+        game = self.game
+        if not game.headless:
+            self._handle_events(pygame.event.get())
+        self._run_commands()
+        while not game.halt and game.debug and not self.steps:
+            with self._lock:
+                waiting = self.commands.empty()
+                if waiting:
+                    self.idle.set()
+            game._lap(None)  # стоим на паузе - это не время кадра
+            if waiting and game.headless:
+                try:  # с таймаутом - иначе в python 2 ожидание не прервать по Ctrl+C
+                    self._pending.append(self.commands.get(timeout=CONTROL_POLL_MS / 1000.0))
+                except Queue.Empty:
+                    pass
+            elif waiting:
+                self._handle_events([pygame.event.wait()])
+            self._run_commands()
+        if game.halt:
             return False
+        game._lap('events')
         return True
 
-    def go(self, debug=False):
-        self.debug = debug
-        if self.debug:
-            self._draw_scene()
-        self.halt = False
-        while not self.halt:
-            if self._proceed_keyboard():
-                self._draw_scene()
+    def after_tick(self):
+        """Шаг сделан - отсчитать step и проверить условие run_until. False - игра встала на паузу"""
+        if self.steps:
+            self.steps -= 1
+            return self.steps > 0
+        if self.until is not None:
+            condition, args = self.until
+            if condition(self.game.world, *args):
+                self._stop()
+                return False
+        return True
+
+
+class ReplayRecorder:
+    """Запись игры в компактный двоичный файл повтора (показывает GameEngine.play_replay)"""
+    # заголовок: REPLAY_MAGIC, версия, размер экрана и зерно, дальше по записи на шаг - см. record
+
+    def __init__(self, world, file_name):
+        self.world = world
+        self.file = open(file_name, 'wb')
+        seed = json.dumps(world.seed)
+        self.file.write(REPLAY_MAGIC + struct.pack('<HHHH', REPLAY_VERSION, world.screenrect.width,
+                                                   world.screenrect.height, len(seed)) + seed)
+        self._sprites = []
+        self._mobile = []
+        self._honey = []
+        self.record()
+        world.on_tick.append(self.record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_array(self, typecode, values):
+        data = array(typecode, values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        self.file.write(data.tostring())
+
+    def record(self):
+        """Записать текущий шаг мира"""
+        spawned = self.world.sprites[len(self._sprites):]
+        self.file.write(struct.pack('<IH', self.world.ticks, len(spawned)))
+        for sprite in spawned:
+            name = sprite._img_file_name
+            self.file.write(struct.pack('<BBB', sprite._static, isinstance(sprite, BeeHive), len(name)) + name)
+            self.file.write(struct.pack('<fff', sprite.coord.x, sprite.coord.y, getattr(sprite, '_honey_max', 0)))
+            if not sprite._static:
+                self._mobile.append(sprite)
+            self._sprites.append(sprite)
+            self._honey.append(None)
+
+        positions = []
+        flags = []
+        for sprite in self._mobile:
+            positions.append(sprite.coord.x)
+            positions.append(sprite.coord.y)
+            state = BEE_STATES.index(sprite._state) if isinstance(sprite, HoneyHolder) else 0
+            flags.append(state | (sprite.vector.dx >= 0) << 2)
+        self.file.write(struct.pack('<I', len(self._mobile)))
+        self._write_array('f', positions)
+        self._write_array('B', flags)
+
+        changed = []
+        honey = []
+        for i, sprite in enumerate(self._sprites):
+            value = getattr(sprite, '_honey', None)
+            if value is not None and value != self._honey[i]:
+                self._honey[i] = value
+                changed.append(i)
+                honey.append(value)
+        self.file.write(struct.pack('<I', len(changed)))
+        self._write_array('I', changed)
+        self._write_array('f', honey)
+
+    def close(self):
+        """Закончить запись"""
+        if self.record in self.world.on_tick:
+            self.world.on_tick.remove(self.record)
+        self.file.close()
+
+
+class ReplaySprite(BaseSprite):
+    """Спрайт повтора - только картинка, бар загрузки и положение из записи"""
+
+    def __init__(self, img_file_name, static, pos, honey_max, honey_meter):
+        self._img_file_name = img_file_name
+        self._static = static
+        self._layer = 0 if static else 2
+        BaseSprite.__init__(self, pos)
+        self.honey_max = honey_max
+        self.honey_meter = None
+        if honey_meter and not self.world.headless:
+            self.honey_meter = HoneyMeter(pos=(pos[0] - 24, pos[1] - 37))
+            self.honey_meter.set_value(0)
+
+    def set_honey(self, honey):
+        if self.honey_max:
+            self._set_load(int((float(honey) / self.honey_max) * 100.0))
+        if self.honey_meter is not None:
+            self.honey_meter.set_value(honey)
+
+    def _tick(self):
+        """Шагов симуляции у повтора нет - только записанные кадры"""
+        pass
+
+
+class ReplayPlayer:
+    """Чтение файла повтора ReplayRecorder: по шагу создает/двигает спрайты ReplaySprite в текущем мире"""
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'rb')
+        magic = self.file.read(len(REPLAY_MAGIC))
+        if magic != REPLAY_MAGIC:
+            raise Exception("%s is not a beegarden replay!" % file_name)
+        version, width, height = self._read('<HHH')
+        if version != REPLAY_VERSION:
+            raise Exception("Unsupported replay version %s" % version)
+        self.resolution = (width, height)
+        self.seed = json.loads(self.file.read(self._read('<H')[0]))  # зерно мира, в котором шла игра
+        self.sprites = []
+        self.mobile = []
+        self.ticks = None
+
+    def _read(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.file.read(size)
+        if len(data) < size:
+            raise EOFError()
+        return struct.unpack(fmt, data)
+
+    def _read_array(self, typecode, count):
+        data = array(typecode)
+        if count:
+            data.fromstring(self.file.read(data.itemsize * count))
+            if sys.byteorder != 'little':
+                data.byteswap()
+        return data
+
+    def step(self):
+        """Показать следующий записанный шаг. Возвращает False, если запись кончилась"""
+        try:
+            self.ticks, spawned = self._read('<IH')
+        except EOFError:
+            return False
+        get_world().ticks = self.ticks
+        for i in range(spawned):
+            static, honey_meter, name_length = self._read('<BBB')
+            name = self.file.read(name_length)
+            x, y, honey_max = self._read('<fff')
+            sprite = ReplaySprite(name, static, (x, y), honey_max, honey_meter)
+            self.sprites.append(sprite)
+            if not static:
+                self.mobile.append(sprite)
+
+        count = self._read('<I')[0]
+        positions = self._read_array('f', count * 2)
+        flags = self._read_array('B', count)
+        for i, sprite in enumerate(self.mobile[:count]):
+            sprite.coord.x, sprite.coord.y = positions[2 * i], positions[2 * i + 1]
+            sprite.rect.center = sprite.coord.to_screen()
+            sprite.rect.clamp_ip(sprite.world.screenrect)
+            sprite.vector.dx = 1 if flags[i] & 4 else -1
+            sprite.state = BEE_STATES[flags[i] & 3]
+
+        count = self._read('<I')[0]
+        indexes = self._read_array('I', count)
+        honey = self._read_array('f', count)
+        for i, value in zip(indexes, honey):
+            self.sprites[i].set_honey(value)
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+class SnapshotRing:
+    """Кольцевой буфер кадров в общей памяти: один процесс пишет кадры, другой берет последний"""
+    # у каждой ячейки свой счетчик (seqlock): пока ее пишут, он нечетный, и читатель перечитывает
+
+    def __init__(self, max_sprites=LIVE_MAX_SPRITES, slots=LIVE_SLOTS):
+        if numpy is None:
+            raise Exception("SnapshotRing: numpy is required!")
+        self.max_sprites = max_sprites
+        self.slots = slots
+        sizes = dict(seq=slots * 8, latest=8, ticks=slots * 8, counts=slots * 8,
+                     positions=slots * max_sprites * 8, flags=slots * max_sprites, honey=slots * max_sprites * 4)
+        self._shared = dict((name, multiprocessing.RawArray('b', size)) for name, size in sizes.items())
+        self._attach()
+        self.latest[0] = -1
+
+    def __getstate__(self):  # в процесс симуляции уходит сама общая память
+        return self.max_sprites, self.slots, self._shared
+
+    def __setstate__(self, state):
+        self.max_sprites, self.slots, self._shared = state
+        self._attach()
+
+    def _attach(self):
+        """Внутренняя, массивы numpy поверх общей памяти"""
+        shared = self._shared
+        self.seq = numpy.frombuffer(shared['seq'], dtype='i8')
+        self.latest = numpy.frombuffer(shared['latest'], dtype='i8')
+        self.ticks = numpy.frombuffer(shared['ticks'], dtype='i8')
+        self.counts = numpy.frombuffer(shared['counts'], dtype='i8')
+        self.positions = numpy.frombuffer(shared['positions'], dtype='f4').reshape((self.slots, self.max_sprites, 2))
+        self.flags = numpy.frombuffer(shared['flags'], dtype='u1').reshape((self.slots, self.max_sprites))
+        self.honey = numpy.frombuffer(shared['honey'], dtype='f4').reshape((self.slots, self.max_sprites))
+
+    def write(self, ticks, positions, flags, honey):
+        """Положить кадр: списки x, y, флагов и мёда по спрайтам"""
+        n = len(flags)
+        if n > self.max_sprites:
+            raise Exception("SnapshotRing: %d sprites, max_sprites is %d" % (n, self.max_sprites))
+        frame = self.latest[0] + 1
+        slot = frame % self.slots
+        self.seq[slot] += 1
+        self.ticks[slot] = ticks
+        self.counts[slot] = n
+        if n:
+            self.positions[slot, :n] = positions
+            self.flags[slot, :n] = flags
+            self.honey[slot, :n] = honey
+        self.seq[slot] += 1
+        self.latest[0] = frame
+
+    def read(self, after=-1):
+        """Последний кадр, если он новее кадра номер after: (номер, шаг, x и y, флаги, мёд), иначе None"""
+        while True:
+            frame = int(self.latest[0])
+            if frame <= after:
+                return None
+            slot = frame % self.slots
+            seq = int(self.seq[slot])
+            if seq % 2:
+                continue
+            n = int(self.counts[slot])
+            result = (frame, int(self.ticks[slot]), self.positions[slot, :n].copy(), self.flags[slot, :n].copy(),
+                      self.honey[slot, :n].copy())
+            if int(self.seq[slot]) == seq:
+                return result
+
+
+class LiveSimulation:
+    """Игра в отдельном процессе для живого показа (GameEngine.watch)"""
+    # кадры приходят через SnapshotRing, а новые спрайты и итог - через очередь
+
+    def __init__(self, setup, args=(), tick_rate=None, max_ticks=None, max_sprites=LIVE_MAX_SPRITES,
+                 snapshot_rate=LIVE_SNAPSHOT_RATE):
+        self.ring = SnapshotRing(max_sprites)
+        self.messages = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_live_main, args=(
+            setup, args, self.ring, self.messages, tick_rate, max_ticks, snapshot_rate))
+        self.process.daemon = True
+        self.process.start()
+        self.resolution = None
+        self.sprites = []
+        self.mobile = []
+        self.ticks = None
+        self.finished = False  # игра кончилась: есть score, ticks и error (traceback, если упала)
+        self.shown = False  # и последний ее кадр показан
+        self.score = None
+        self.error = None
+        self._frame = -1
+        self._honey = []
+
+    def _receive(self, block):
+        """Внутренняя, разобрать сообщения процесса. block - дождаться хотя бы одного"""
+        while True:
+            try:
+                message = self.messages.get(timeout=1.0) if block else self.messages.get_nowait()
+            except Queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                if block:
+                    raise Exception("LiveSimulation: simulation process died")
+                return
+            block = False
+            if message[0] == 'start':
+                self.resolution = message[1]
+                if self.resolution != get_world().screenrect.size:
+                    raise Exception("LiveSimulation: game resolution %s differs from the window's %s" % (
+                        self.resolution, get_world().screenrect.size))
+            elif message[0] == 'sprites':
+                for name, static, honey_meter, x, y, honey_max in message[1]:
+                    sprite = ReplaySprite(name, static, (x, y), honey_max, honey_meter)
+                    self.sprites.append(sprite)
+                    self._honey.append(None)
+                    if not static:
+                        self.mobile.append(sprite)
+            elif message[0] == 'end':
+                self.score, self.ticks, self.error = message[1:]
+                self.finished = True
+
+    def step(self):
+        """Показать последний готовый кадр игры. False - игра кончилась и ее последний кадр уже показан"""
+        self._receive(block=False)
+        finished = self.finished  # кадр, записанный до конца игры, надо еще показать
+        frame = self.ring.read(self._frame)
+        if frame is None:
+            self.shown = finished
+            return not finished
+        self._frame, self.ticks, positions, flags, honey = frame
+        get_world().ticks = self.ticks
+        while len(self.sprites) < len(flags):  # описания новых спрайтов идут отдельно - ждем их
+            self._receive(block=True)
+        screenrect = get_world().screenrect
+        for sprite, (x, y), flag in zip(self.sprites, positions.tolist(), flags.tolist()):
+            if sprite._static:
+                continue
+            sprite.coord.x, sprite.coord.y = x, y
+            sprite.rect.center = sprite.coord.to_screen()
+            sprite.rect.clamp_ip(screenrect)
+            sprite.vector.dx = 1 if flag & 4 else -1
+            sprite.state = BEE_STATES[flag & 3]
+        for i, value in enumerate(honey.tolist()):
+            if value != self._honey[i]:
+                self._honey[i] = value
+                self.sprites[i].set_honey(value)
+        return True
+
+    def close(self):
+        """Остановить процесс игры, если она еще идет"""
+        _stop_process(self.process)
+
+
+def _live_layout(sprite):
+    """Внутренняя, описание спрайта для ReplaySprite"""
+    return (sprite._img_file_name, sprite._static, isinstance(sprite, BeeHive), sprite.coord.x, sprite.coord.y,
+            getattr(sprite, '_honey_max', 0))
+
+
+def _live_frame(world):
+    """Внутренняя, кадр мира для SnapshotRing: x и y, флаги и мёд спрайтов"""
+    positions, flags, honey = [], [], []
+    for sprite in world.sprites:
+        positions.append((sprite.coord.x, sprite.coord.y))
+        state = BEE_STATES.index(sprite._state) if isinstance(sprite, HoneyHolder) and not sprite._static else 0
+        flags.append(state | (sprite.vector.dx >= 0) << 2)
+        honey.append(getattr(sprite, '_honey', 0))
+    return positions, flags, honey
+
+
+def _live_main(setup, args, ring, messages, tick_rate, max_ticks, snapshot_rate):
+    """Процесс LiveSimulation: крутит игру и кладет ее кадры в кольцо"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # см. _sandbox_main
+    world = None
+    sent = 0
+    error = None
+    try:
+        world = setup(*args).world
+        world.activate()
+        messages.put(('start', world.screenrect.size))
+        max_tick = None if max_ticks is None else world.ticks + max_ticks
+        interval = 1.0 / snapshot_rate
+        start = default_timer()
+        snapshot_time = start
+        while True:
+            if sent < len(world.sprites):
+                messages.put(('sprites', [_live_layout(sprite) for sprite in world.sprites[sent:]]))
+                sent = len(world.sprites)
+            now = default_timer()
+            if now >= snapshot_time:
+                ring.write(world.ticks, *_live_frame(world))
+                snapshot_time = now + interval
+            if world.is_finished() or not world.advance(max_tick):
+                break
+            if tick_rate:
+                delay = start + float(world.ticks) / tick_rate - default_timer()
+                if delay > 0:
+                    time.sleep(delay)
+    except Exception:  # упавший код пчел - игра кончилась, итог какой есть
+        error = traceback.format_exc()
+    if world is None:
+        messages.put(('end', {}, 0, error))
+        return
+    if sent < len(world.sprites):
+        messages.put(('sprites', [_live_layout(sprite) for sprite in world.sprites[sent:]]))
+    ring.write(world.ticks, *_live_frame(world))
+    messages.put(('end', world.get_score(), world.ticks, error))
+
+
+class TelemetryRecorder:
+    """Телеметрия матча по шагам: мёд в ульях и цветках и пчелы команд по состояниям (BEE_STATES)"""
+    # в файл пишет фоновый поток кусками по chunk_ticks строк; столбцы описаны в JSON-заголовке
+
+    def __init__(self, world, file_name, chunk_ticks=TELEMETRY_CHUNK, per_flower=False):
+        self.world = world
+        self.chunk_ticks = chunk_ticks
+        self.teams = range(1, len(world.beehives) + 1)
+        self._team_slots = dict((team, i * len(BEE_STATES)) for i, team in enumerate(self.teams))
+        self._state_slots = dict((state, i) for i, state in enumerate(BEE_STATES))
+        # цветки - из world.sprites: world.flowers код пчел может менять
+        self._flowers = [sprite for sprite in world.sprites if isinstance(sprite, Flower)] if per_flower else None
+        self.columns = [('tick', 'I', []), ('hive_honey', 'f', [len(world.beehives)]),
+                        ('flower_honey', 'f', []), ('flowers_with_honey', 'I', []),
+                        ('bee_states', 'I', [len(self.teams), len(BEE_STATES)])]
+        if per_flower:
+            self.columns.append(('flowers', 'f', [len(self._flowers)]))
+        header = json.dumps(dict(columns=self.columns, teams=self.teams, states=BEE_STATES,
+                                 resolution=world.screenrect.size, seed=world.seed))
+        self.file = open(file_name, 'wb')
+        self.file.write(TELEMETRY_MAGIC + struct.pack('<HI', TELEMETRY_VERSION, len(header)) + header)
+        self._queue = Queue.Queue(maxsize=TELEMETRY_QUEUE)
+        self._writer = threading.Thread(target=self._write_chunks, name='telemetry')
+        self._writer.daemon = True
+        self._writer.start()
+        self._error = None
+        self._new_buffers()
+        self.record()
+        world.on_tick.append(self.record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _new_buffers(self):
+        self._buffers = [array(typecode) for name, typecode, shape in self.columns]
+        self._rows = 0
+
+    def record(self):
+        """Добавить строку текущего шага"""
+        world = self.world
+        buffers = self._buffers
+        buffers[0].append(world.ticks)
+        buffers[1].extend(beehive._honey for beehive in world.beehives)
+        if world.scene is not None:  # в индексе сцены - только цветки с мёдом
+            flowers = world.scene.flowers_index
+            buffers[2].append(sum(flower._honey for flower in flowers))
+            buffers[3].append(len(flowers))
+        else:
+            flowers = [sprite for sprite in world.sprites if isinstance(sprite, Flower)]
+            buffers[2].append(sum(flower._honey for flower in flowers))
+            buffers[3].append(sum(1 for flower in flowers if flower._honey > 0))
+        counts = [0] * (len(self.teams) * len(BEE_STATES))
+        team_slots, state_slots = self._team_slots, self._state_slots
+        for bee in world.bees:
+            slot = team_slots.get(bee.team)
+            if slot is not None:
+                counts[slot + state_slots[bee._state]] += 1
+        buffers[4].extend(counts)
+        if self._flowers is not None:
+            buffers[5].extend(flower._honey for flower in self._flowers)
+        self._rows += 1
+        if self._rows >= self.chunk_ticks:
+            self._flush()
+
+    def _flush(self):
+        """Внутренняя, отдать накопленный кусок фоновому потоку"""
+        if self._error is not None:
+            raise Exception("TelemetryRecorder: writing failed\n%s" % self._error)
+        if self._rows:
+            self._queue.put((self._rows, self._buffers))
+            self._new_buffers()
+
+    def _write_chunks(self):
+        """Внутренняя, фоновый поток записи кусков"""
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is not None:
+                continue
+            rows, buffers = chunk
+            try:
+                self.file.write(struct.pack('<I', rows))
+                for data in buffers:
+                    if sys.byteorder != 'little':
+                        data.byteswap()
+                    self.file.write(data.tostring())
+            except Exception:
+                self._error = traceback.format_exc()
+
+    def close(self):
+        """Дописать последний кусок и закончить запись"""
+        if self.record in self.world.on_tick:
+            self.world.on_tick.remove(self.record)
+        try:
+            self._flush()
+        finally:
+            self._queue.put(None)
+            self._writer.join()
+            self.file.close()
+        if self._error is not None:
+            raise Exception("TelemetryRecorder: writing failed\n%s" % self._error)
+
+
+def read_telemetry(file_name):
+    """Прочитать файл TelemetryRecorder: (OrderedDict имя -> массив numpy по строке на шаг, заголовок)"""
+    # недописанный последний кусок (матч оборвался) пропускается
+    if numpy is None:
+        raise Exception("read_telemetry: numpy is required")
+    with open(file_name, 'rb') as telemetry:
+        if telemetry.read(len(TELEMETRY_MAGIC)) != TELEMETRY_MAGIC:
+            raise Exception("%s is not a beegarden telemetry file!" % file_name)
+        version, header_length = struct.unpack('<HI', telemetry.read(6))
+        if version != TELEMETRY_VERSION:
+            raise Exception("Unsupported telemetry version %s" % version)
+        meta = json.loads(telemetry.read(header_length))
+        chunks = dict((name, []) for name, typecode, shape in meta['columns'])
+        while True:
+            data = telemetry.read(4)
+            if len(data) < 4:
+                break
+            rows = struct.unpack('<I', data)[0]
+            chunk = []
+            for name, typecode, shape in meta['columns']:
+                dtype = numpy.dtype(TELEMETRY_DTYPES[typecode])
+                count = rows * int(numpy.prod(shape))
+                data = telemetry.read(count * dtype.itemsize)
+                if len(data) < count * dtype.itemsize:
+                    break
+                chunk.append((name, numpy.frombuffer(data, dtype).reshape([rows] + shape)))
+            else:
+                for name, values in chunk:
+                    chunks[name].append(values)
+                continue
+            break
+    columns = OrderedDict()
+    for name, typecode, shape in meta['columns']:
+        if chunks[name]:
+            columns[name] = numpy.concatenate(chunks[name])
+        else:
+            columns[name] = numpy.zeros([0] + shape, TELEMETRY_DTYPES[typecode])
+    return columns, meta
+
+
+class Profiler:
+    """Профайлер игры: время фаз кадра, обработчиков по классам объектов и число вызовов методов"""
+    # время обработчика считается без вложенных в него, так что по классам оно не двоится
+
+    def __init__(self, world, counted=PROFILER_COUNTED, keep_frames=True):
+        """Включить профайлер в мире. keep_frames - хранить строки всех кадров для dump_csv"""
+        self.world = world
+        self.counted = counted
+        self.keep_frames = keep_frames
+        self.frames = []  # кадр, шаг мира, мс по фазам, мс в обработчиках
+        self.recent = deque(maxlen=PROFILER_WINDOW)  # последние кадры - для показа в игре
+        self.frames_count = 0
+        self.phases = dict((phase, 0.0) for phase in PROFILER_PHASES)  # секунд за всю игру
+        self.callbacks = {}  # (класс, обработчик) -> [вызовов, секунд, самый долгий вызов]
+        self.counts = {}  # (класс, метод) -> вызовов
+        self._frame = dict(self.phases)
+        self._frame_callbacks = 0.0
+        self._nested = []  # время вложенных обработчиков для каждого выполняющегося
+        self._mark = default_timer()
+        world.profiler = self
+        for sprite in world.sprites:
+            self.watch(sprite)
+
+    @staticmethod
+    def label(sprite):
+        """Под каким именем считать объект"""
+        if isinstance(sprite, Bee):
+            return '%s/%s' % (type(sprite).__name__, sprite.team)
+        return type(sprite).__name__
+
+    def watch(self, sprite):
+        """Считать вызовы методов counted у объекта"""
+        label = self.label(sprite)
+        for name in self.counted:
+            method = getattr(sprite, name, None)
+            if method is not None and name not in sprite.__dict__:
+                sprite.__dict__[name] = self._counter((label, name), method)
+
+    def _counter(self, key, method):
+        counts = self.counts
+        counts.setdefault(key, 0)
+
+        def counted(*args, **kwargs):
+            counts[key] += 1
+            return method(*args, **kwargs)
+        counted._engine_wrapper = True  # World.fork их снимает
+        return counted
+
+    def call(self, sprite, handler, args):
+        """Вызвать обработчик события объекта и засечь его время"""
+        self._nested.append(0.0)
+        start = default_timer()
+        try:
+            return getattr(sprite, handler)(*args)
+        finally:
+            elapsed = default_timer() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            else:
+                self._frame_callbacks += elapsed
+            key = (self.label(sprite), handler)
+            stat = self.callbacks.get(key)
+            if stat is None:
+                stat = self.callbacks[key] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += elapsed - nested
+            stat[2] = max(stat[2], elapsed - nested)
+
+    def lap(self, phase):
+        """Время с прошлой отметки отнести к фазе кадра phase (None - не считать)"""
+        now = default_timer()
+        if phase is not None:
+            self._frame[phase] += now - self._mark
+        self._mark = now
+
+    def end_frame(self):
+        """Кадр закончен - записать его строку"""
+        row = [self.frames_count, self.world.ticks]
+        for phase in PROFILER_PHASES:
+            row.append(self._frame[phase] * 1000)
+            self.phases[phase] += self._frame[phase]
+            self._frame[phase] = 0.0
+        row.append(self._frame_callbacks * 1000)
+        self._frame_callbacks = 0.0
+        self.frames_count += 1
+        self.recent.append(row)
+        if self.keep_frames:
+            self.frames.append(row)
+
+    def class_totals(self):
+        """Время обработчиков событий по классам, мс: [(класс, мс)] от самого медленного"""
+        totals = {}
+        for (label, handler), (calls, seconds, longest) in self.callbacks.items():
+            totals[label] = totals.get(label, 0.0) + seconds * 1000
+        return sorted(totals.items(), key=lambda item: -item[1])
+
+    def summary(self):
+        """Итоги: фазы, обработчики и счетчики вызовов - словарь, готовый для JSON"""
+        frames = self.frames_count or 1
+        return dict(
+            frames=self.frames_count,
+            ticks=self.world.ticks,
+            phases=dict((phase, dict(total_ms=seconds * 1000, avg_ms=seconds * 1000 / frames))
+                        for phase, seconds in self.phases.items()),
+            callbacks=[dict(cls=label, handler=handler, calls=calls, total_ms=seconds * 1000,
+                            max_ms=longest * 1000)
+                       for (label, handler), (calls, seconds, longest) in
+                       sorted(self.callbacks.items(), key=lambda item: -item[1][1])],
+            classes=[dict(cls=label, total_ms=total) for label, total in self.class_totals()],
+            counts=[dict(cls=label, method=name, calls=calls)
+                    for (label, name), calls in sorted(self.counts.items())],
+        )
+
+    def dump_json(self, file_name):
+        """Сохранить итоги в JSON"""
+        with open(file_name, 'w') as dump:
+            json.dump(self.summary(), dump, indent=2, sort_keys=True)
+
+    def dump_csv(self, file_name):
+        """Сохранить строки кадров в CSV: кадр, шаг мира, мс по фазам, мс в обработчиках"""
+        with open(file_name, 'wb') as dump:
+            writer = csv.writer(dump)
+            writer.writerow(['frame', 'tick'] + ['%s_ms' % phase for phase in PROFILER_PHASES] + ['callbacks_ms'])
+            writer.writerows(self.frames)
+
+
+class CallbackBudget:
+    """Бюджет времени на обработчики пчел: сколько мс за шаг может занять код каждого класса пчел"""
+    # policy при превышении: 'skip' - событие приходит после шага вне бюджета, 'defer' - после шага в счет
+    # следующего, 'penalize' - вызов сразу, но со штрафом мёдом за каждую мс сверх бюджета
+
+    def __init__(self, world, budget_ms=None, policy='defer', penalty=1.0, isolate=False, timeout=1.0):
+        """Включить бюджет в мире. budget_ms - мс на класс пчел за шаг (None - без ограничения),
+        isolate - код каждой команды в своем процессе (TeamSandbox), вызов дольше timeout секунд обрывается"""
+        if policy not in BUDGET_POLICIES:
+            raise Exception("CallbackBudget: policy must be one of %s, not %s" % (BUDGET_POLICIES, policy))
+        self.world = world
+        self.budget = None if budget_ms is None else budget_ms / 1000.0
+        self.policy = policy
+        self.penalty = penalty
+        self.isolate = isolate
+        self.timeout = timeout
+        # класс -> [вызовов, секунд, шагов с превышением, пропущено, отложено, штраф мёдом, оборвано]
+        self.stats = {}
+        self.sandboxes = {}  # команда -> TeamSandbox
+        self._spent = {}  # класс -> секунд в текущем шаге
+        self._tick = None
+        self._deferred = []  # (пчела, обработчик, аргументы, почему вызывается снова: policy или 'retry')
+        self._depth = 0
+        world.budget = self
+        world.on_tick.append(self._run_deferred)
+
+    def call(self, sprite, handler, args, redelivery=None):
+        """Вызвать обработчик события объекта, если бюджет его класса позволяет. redelivery - см. _deferred"""
+        if self._depth or not isinstance(sprite, Bee):
+            return sprite._call(handler, args)
+        if self.world.ticks != self._tick:
+            self._tick = self.world.ticks
+            self._spent.clear()
+        label = Profiler.label(sprite)
+        stat = self.stats.get(label)
+        if stat is None:
+            stat = self.stats[label] = [0, 0.0, 0, 0, 0, 0.0, 0]
+        spent = self._spent.get(label, 0.0)
+        charged = redelivery != 'skip'
+        if charged and self.budget is not None and spent >= self.budget and self.policy != 'penalize':
+            # события разовые - выброшенное оставило бы пчелу стоять до конца игры
+            stat[4 if self.policy == 'defer' else 3] += 1
+            self._deferred.append((sprite, handler, args, self.policy))
+            return None
+        sandbox = None
+        if self.isolate:
+            sandbox = self.sandboxes.get(sprite.team)
+            if sandbox is None:
+                sandbox = self.sandboxes[sprite.team] = TeamSandbox(self.world, sprite.team, self.timeout)
+        self._depth += 1
+        start = default_timer()
+        try:
+            if sandbox is None:
+                return sprite._call(handler, args)
+            if not sandbox.call(sprite, handler, args):
+                stat[6] += 1
+                if redelivery != 'retry':  # еще раз, в новом процессе - но только раз, зависший код ждем не каждый шаг
+                    self._deferred.append((sprite, handler, args, 'retry'))
+        finally:
+            self._depth -= 1
+            elapsed = default_timer() - start
+            stat[0] += 1
+            stat[1] += elapsed
+            if charged:
+                self._spent[label] = spent + elapsed
+            if charged and self.budget is not None and spent + elapsed > self.budget:
+                if spent <= self.budget:
+                    stat[2] += 1
+                if self.policy == 'penalize':
+                    stat[5] += self._fine(sprite, min(elapsed, spent + elapsed - self.budget))
+
+    def _fine(self, bee, seconds):
+        """Внутренняя, списать из улья пчелы штраф за seconds сверх бюджета. Возвращает списанный мёд"""
+        beehive = bee.my_beehive
+        honey = min(beehive._honey, seconds * 1000 * self.penalty)
+        if honey > 0:
+            beehive._honey -= honey
+            beehive._honey_changed()
+        return honey
+
+    def _run_deferred(self):
+        """Внутренняя, после шага - вызвать отложенные, пропущенные и оборванные обработчики"""
+        if not self._deferred:
+            return
+        deferred, self._deferred = self._deferred, []
+        for sprite, handler, args, redelivery in deferred:
+            self.call(sprite, handler, args, redelivery)
+        if self.world.events is not None:
+            for sprite, handler, args, redelivery in self._deferred:
+                self.world.events.wake(sprite)  # иначе следующего шага может и не быть
+
+    def close(self):
+        """Остановить процессы команд"""
+        for sandbox in self.sandboxes.values():
+            sandbox.close()
+
+    def summary(self):
+        """Итоги по классам пчел - словари, готовые для JSON"""
+        return [dict(cls=label, calls=calls, total_ms=seconds * 1000, overruns=overruns, skipped=skipped,
+                     deferred=deferred, penalty=penalty, timeouts=timeouts)
+                for label, (calls, seconds, overruns, skipped, deferred, penalty, timeouts) in
+                sorted(self.stats.items(), key=lambda item: -item[1][1])]
+
+
+class TeamSandbox:
+    """Процесс, в котором выполняется код пчел одной команды (CallbackBudget(isolate=True))"""
+    # код видит зеркало мира на начало шага; оборванный по timeout процесс запускается заново,
+    # и состояние пчел в нем теряется
+
+    def __init__(self, world, team, timeout=1.0):
+        self.world = world
+        self.team = team
+        self.timeout = timeout
+        self.timeouts = 0
+        self.process = None
+        self._connection = None
+
+    def _start(self):
+        """Внутренняя, запустить процесс с пустым зеркалом"""
+        world = self.world
+        self._connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_sandbox_main, args=(child, self.team))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self._sent = 0  # сколько спрайтов уже есть в зеркале
+        self._holders = []  # цветки и ульи из world.sprites - world.flowers код пчел может менять
+        self._honey = {}  # номер спрайта -> отправленный мёд
+        self._tick = None
+        self._connection.send(('init', world.screenrect.size, world.seed, world.speed, world.honey_speed))
+
+    def close(self):
+        """Остановить процесс"""
+        if self.process is not None:
+            _stop_process(self.process)
+            self._connection.close()
+            self.process = None
+
+    def call(self, bee, handler, args):
+        """Выполнить обработчик пчелы в процессе. False - вызов не уложился в timeout (или процесс упал) и оборван"""
+        if self.process is None:
+            self._start()
+        world = self.world
+        layouts = snapshot = None
+        if self._sent < len(world.sprites):
+            new_sprites = world.sprites[self._sent:]
+            layouts = [_sandbox_layout(sprite) for sprite in new_sprites]
+            self._holders.extend(sprite for sprite in new_sprites if isinstance(sprite, (Flower, BeeHive)))
+            self._sent = len(world.sprites)
+        if self._tick != world.ticks:
+            self._tick = world.ticks
+            snapshot = self._snapshot()
+        self._connection.send(('call', layouts, snapshot, _sandbox_state(bee), handler,
+                               [_sandbox_ref(arg) for arg in args]))
+        try:
+            if self._connection.poll(self.timeout):
+                status, result = self._connection.recv()
+            else:
+                status = None
+        except (IOError, EOFError):  # процесс умер сам
+            status = None
+        if status is None:
+            self.close()
+            self.timeouts += 1
+            return False
+        if status == 'error':
+            raise Exception("TeamSandbox: bee code of team %s failed\n%s" % (self.team, result))
+        sprites = world.sprites
+        for bee_id, name, command_args in result:
+            getattr(sprites[bee_id - 1], name)(*[_sandbox_deref(sprites, arg) for arg in command_args])
+        return True
+
+    def _snapshot(self):
+        """Внутренняя, снимок мира для зеркала: шаг, изменившийся мёд цветков и ульев, пчелы, заявки"""
+        world = self.world
+        honey = []
+        for holder in self._holders:
+            if self._honey.get(holder._id) != holder._honey:
+                self._honey[holder._id] = holder._honey
+                honey.append((holder._id, holder._honey))
+        claims = []
+        if world.scene is not None:
+            claims = [(bee._id, flower._id) for bee, flower in world.scene.claims._bees.items()]
+        return world.ticks, honey, [_sandbox_state(bee) for bee in world.bees], claims
+
+
+def _sandbox_ref(obj):
+    """Внутренняя, спрайт или точка - в вид, который можно передать в другой процесс"""
+    if isinstance(obj, BaseSprite):
+        return ('sprite', obj._id)
+    if isinstance(obj, Point):
+        return ('point', obj.x, obj.y)
+    return obj
+
+
+def _sandbox_deref(sprites, ref):
+    """Внутренняя, обратно к _sandbox_ref"""
+    if type(ref) is tuple and ref:
+        if ref[0] == 'sprite':
+            return sprites[ref[1] - 1]
+        if ref[0] == 'point':
+            return Point.from_xy(ref[1], ref[2])
+    return ref
+
+
+def _sandbox_class_path(cls):
+    """Внутренняя, (модуль, имя) ближайшего класса, который можно импортировать в процессе команды"""
+    for klass in cls.__mro__:
+        module = sys.modules.get(klass.__module__)
+        if getattr(module, klass.__name__, None) is klass:
+            return klass.__module__, klass.__name__
+    return None
+
+
+def _sandbox_layout(sprite):
+    """Внутренняя, что нужно, чтобы создать спрайт в зеркале"""
+    if isinstance(sprite, Bee):
+        kind = 'bee'
+    elif isinstance(sprite, Flower):
+        kind = 'flower'
+    elif isinstance(sprite, BeeHive):
+        kind = 'beehive'
+    else:
+        kind = 'sprite'
+    return (kind, _sandbox_class_path(type(sprite)) if kind == 'bee' else None, getattr(sprite, 'team', None),
+            sprite.coord.x, sprite.coord.y, getattr(sprite, '_honey', 0), getattr(sprite, '_honey_max', 1),
+            sprite.speed)
+
+
+def _sandbox_state(bee):
+    """Внутренняя, состояние пчелы для зеркала"""
+    return (bee._id, bee.coord.x, bee.coord.y, bee.vector.dx, bee.vector.dy, bee.is_moving, bee._honey,
+            bee._state, _sandbox_ref(getattr(bee, 'target', None)), _sandbox_ref(bee._source),
+            _sandbox_ref(bee._target))
+
+
+class _MirrorScene(Scene):
+    """Сцена зеркала TeamSandbox: цветки и ульи приходят из настоящего мира"""
+
+    def __init__(self, world):
+        self._attach(world)
+
+
+class _SandboxMirror:
+    """Зеркало мира в процессе TeamSandbox: цветки, ульи и пчелы с теми же номерами, что в настоящем"""
+
+    def __init__(self, team, resolution, seed, speed, honey_speed):
+        self.team = team
+        self.world = World(resolution=resolution, headless=True, seed=seed)
+        self.world.activate()
+        self.world.speed = speed
+        self.world.honey_speed = honey_speed
+        self.scene = _MirrorScene(self.world)
+        self.commands = []
+        self._recording = False
+        self._classes = {}
+
+    def call(self, sprite, handler, args):
+        """Бюджет мира на время создания пчел: их on_born уже вызван в настоящем мире"""
+        return None
+
+    def _bee_class(self, class_path, team):
+        """Внутренняя, класс пчелы: у своей команды - настоящий, у соперника - просто Bee"""
+        key = (class_path, team)
+        if key not in self._classes:
+            if team == self.team and class_path is not None:
+                cls = getattr(importlib.import_module(class_path[0]), class_path[1])
+                if cls.team != team:
+                    cls = type(cls.__name__, (cls,), {'team': team})
+            else:
+                cls = type('Bee', (Bee,), {'team': team})
+            self._classes[key] = cls
+        return self._classes[key]
+
+    def add(self, layouts):
+        """Создать новые спрайты настоящего мира"""
+        world = self.world
+        world.budget = self
+        try:
+            for kind, class_path, team, x, y, honey, honey_max, speed in layouts:
+                if kind == 'flower':
+                    sprite = Flower((x, y))
+                    world.flowers.append(sprite)
+                elif kind == 'beehive':
+                    sprite = BeeHive((x, y), max_honey=honey_max)
+                    world.beehives.append(sprite)
+                elif kind == 'bee':
+                    sprite = self._bee_class(class_path, team)()
+                    if team == self.team:
+                        for name in SANDBOX_COMMANDS:
+                            sprite.__dict__[name] = self._recorder(sprite, name, getattr(sprite, name))
+                else:
+                    sprite = BaseSprite((x, y))
+                sprite.speed = speed
+                if isinstance(sprite, HoneyHolder):
+                    sprite._honey, sprite._honey_max = honey, honey_max
+        finally:
+            world.budget = None
+
+    def _recorder(self, bee, name, method):
+        """Внутренняя, команда пчелы, которая записывается для повтора в настоящем мире"""
+        def record(*args):
+            if self._recording:  # вложенные команды повторит сама внешняя
+                return method(*args)
+            self.commands.append((bee._id, name, [_sandbox_ref(arg) for arg in args]))
+            self._recording = True
+            try:
+                return method(*args)
+            finally:
+                self._recording = False
+        record._engine_wrapper = True  # World.fork их снимает
+        return record
+
+    def update(self, snapshot):
+        """Привести зеркало к снимку настоящего мира"""
+        ticks, honey, bees, claims = snapshot
+        sprites = self.world.sprites
+        self.world.ticks = ticks
+        for sprite_id, value in honey:
+            sprite = sprites[sprite_id - 1]
+            sprite._honey = value
+            if value <= 0 and isinstance(sprite, Flower) and sprite._index is not None:
+                sprite._index.remove(sprite)
+                self.scene.flowers_with_honey.remove(sprite)
+        for state in bees:
+            self._set_state(state)
+        self.scene.claims = ClaimRegistry()
+        for bee_id, flower_id in claims:
+            self.scene.claims.claim(sprites[bee_id - 1], sprites[flower_id - 1])
+
+    def _set_state(self, state):
+        """Внутренняя, перенести состояние пчелы из настоящего мира"""
+        sprites = self.world.sprites
+        bee_id, x, y, dx, dy, is_moving, honey, bee_state, target, source, honey_target = state
+        bee = sprites[bee_id - 1]
+        bee.coord.x = x
+        bee.coord.y = y
+        bee.vector = Vector.from_xy(dx, dy)
+        bee.is_moving = is_moving
+        bee._honey = honey
+        bee._state = bee_state
+        target = _sandbox_deref(sprites, target)
+        if target is not None:
+            bee.target = target
+            bee.target_coord = target.coord if isinstance(target, BaseSprite) else target
+        bee._source = _sandbox_deref(sprites, source)
+        bee._target = _sandbox_deref(sprites, honey_target)
+        bee.rect.center = bee.coord.to_screen(bee.world.screenrect.height)
+        self.scene.bees_index.move(bee)
+
+    def run(self, layouts, snapshot, state, handler, args):
+        """Выполнить обработчик пчелы. Возвращает записанные команды"""
+        if layouts:
+            self.add(layouts)
+        if snapshot:
+            self.update(snapshot)
+        self._set_state(state)
+        sprites = self.world.sprites
+        self.commands = []
+        getattr(sprites[state[0] - 1], handler)(*[_sandbox_deref(sprites, arg) for arg in args])
+        return self.commands
+
+
+def _stop_process(process, timeout=1.0):
+    """Остановить дочерний процесс: SIGTERM, а если за timeout секунд не вышел - SIGKILL"""
+    if process.is_alive():
+        process.terminate()
+        process.join(timeout)
+    if process.is_alive():
+        os.kill(process.pid, signal.SIGKILL)
+    process.join()
+
+
+def _sandbox_main(connection, team):
+    """Процесс TeamSandbox: принимает вызовы, отвечает командами пчел или текстом ошибки"""
+    # после pygame.init() SDL перехватывает SIGTERM, и процесс наследует это - terminate() не сработает
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    mirror = None
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message[0] == 'init':
+            mirror = _SandboxMirror(team, *message[1:])
+            continue
+        try:
+            connection.send(('ok', mirror.run(*message[1:])))
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
 
 
 class Fps(pygame.sprite.DirtySprite):
     """Отображение FPS игры"""
     _layer = 5
 
-    def __init__(self, color=(255, 255, 255)):
+    def __init__(self, clock, color=(255, 255, 255)):
         """Создать индикатор FPS"""
-        pygame.sprite.Sprite.__init__(self, self.containers)
+        world = get_world()
+        pygame.sprite.DirtySprite.__init__(self, world.all)
+        self.clock = clock
         self.show = False
         self.font = pygame.font.Font(None, 27)
         self.color = color
         self.image = self.font.render('-', 0, self.color)
         self.rect = self.image.get_rect()
-        self.rect = self.rect.move(SCREENRECT.width - 100, 10)
+        self.rect = self.rect.move(world.screenrect.width - 100, 10)
         self.fps = []
+        self.msg = None
 
     def update(self):
         """Обновить значение FPS"""
-        global clock
-        current_fps = clock.get_fps()
-        del self.fps[100:]
+        current_fps = self.clock.get_fps()
+        del self.fps[:-99]
         self.fps.append(current_fps)
         if self.show:
             fps = sum(self.fps) / len(self.fps)
             msg = '%5.0f FPS' % fps
         else:
             msg = ''
-        self.image = self.font.render(msg, 1, self.color)
+        if msg != self.msg:  # текст рендерим только когда он поменялся
+            self.msg = msg
+            self.image = self.font.render(msg, 1, self.color)
+            self.rect = self.image.get_rect(topleft=self.rect.topleft)
+            self.dirty = 1
+
+
+class ProfilerOverlay(pygame.sprite.DirtySprite):
+    """Показ профайлера в игре: средние по последним кадрам времена фаз и самые медленные классы"""
+    _layer = 5
+    refresh_frames = 15  # текст обновляется раз в столько кадров
+
+    def __init__(self, profiler, color=(255, 255, 0), background=(0, 0, 0)):
+        world = get_world()
+        pygame.sprite.DirtySprite.__init__(self, world.all)
+        self.profiler = profiler
+        self.show = False
+        self.font = pygame.font.Font(None, 20)
+        self.color = color
+        self.background = background
+        self.image = self.font.render('', 0, self.color)
+        self.rect = self.image.get_rect(topleft=(10, 10))
+        self.lines = None
+        self._frames = 0
+
+    def get_lines(self):
+        """Строки отчета"""
+        recent = self.profiler.recent
+        if not recent:
+            return ['profiler: no frames yet']
+        count = float(len(recent))
+        averages = [sum(row[i] for row in recent) / count for i in range(len(recent[0]))]
+        phases = dict(zip(PROFILER_PHASES, averages[2:]))
+        lines = ['  '.join('%s %.1f' % (phase, phases[phase]) for phase in PROFILER_PHASES) + ' ms/frame',
+                 'bee callbacks %.2f ms/frame' % averages[-1]]
+        frames = self.profiler.frames_count
+        for label, total in self.profiler.class_totals()[:5]:
+            lines.append('  %s %.2f ms/frame' % (label, total / frames))
+        counts = {}
+        for (label, name), calls in self.profiler.counts.items():
+            counts[name] = counts.get(name, 0) + calls
+        if counts:
+            lines.append('  '.join('%s %d' % item for item in sorted(counts.items())))
+        return lines
+
+    def update(self):
+        if not self.show:
+            lines = []
+        elif self._frames % self.refresh_frames == 0 or not self.lines:
+            lines = self.get_lines()
+        else:
+            lines = self.lines
+        self._frames += 1
+        if lines != self.lines:  # текст рендерим только когда он поменялся
+            self.lines = lines
+            rendered = [self.font.render(line, 1, self.color, self.background) for line in lines]
+            width = max([line.get_width() for line in rendered] or [0])
+            height = sum(line.get_height() for line in rendered)
+            self.image = pygame.Surface((width, height))  # на темной подложке - читается поверх любых спрайтов
+            self.image.fill(self.background)
+            y = 0
+            for line in rendered:
+                self.image.blit(line, (0, y))
+                y += line.get_height()
+            self.rect = self.image.get_rect(topleft=self.rect.topleft)
+            self.dirty = 1
 
 
 class HoneyMeter(pygame.sprite.DirtySprite):
@@ -699,27 +3664,32 @@ class HoneyMeter(pygame.sprite.DirtySprite):
     _layer = MAX_LAYERS
 
     def __init__(self, pos, color=(255, 255, 0)):
-        self.containers = self.containers, SPRITES_GROUPS[self._layer]
-        pygame.sprite.Sprite.__init__(self, self.containers)
+        world = get_world()
+        pygame.sprite.DirtySprite.__init__(self, (world.all, world.sprites_groups[self._layer]))
         self.font = pygame.font.Font(None, 27)
         self.color = color
         self.image = self.font.render('-', 0, self.color)
         self.rect = self.image.get_rect()
-        self.rect = self.rect.move(pos[0], SCREENRECT.height - pos[1])
+        self.rect = self.rect.move(pos[0], world.screenrect.height - pos[1])
+        self.msg = None
 
     def set_value(self, value):
         self.value = value
 
     def update(self):
         msg = '%5.0f' % self.value
-        self.image = self.font.render(msg, 1, self.color)
+        if msg != self.msg:  # текст рендерим только когда он поменялся
+            self.msg = msg
+            self.image = self.font.render(msg, 1, self.color)
+            self.rect = self.image.get_rect(topleft=self.rect.topleft)
+            self.dirty = 1
 
 
 def random_number(a=0, b=300):
     """
         Выдать случайное целое из диапазона [a,b]
     """
-    return random.randint(a, b)
+    return get_world().random.randint(a, b)
 
 
 def _get_random_coordinate(high):
@@ -730,48 +3700,37 @@ def random_point():
     """
         Сгенерировать случнайную точку внутри области рисования
     """
-    x = _get_random_coordinate(SCREENRECT.width)
-    y = _get_random_coordinate(SCREENRECT.height)
+    screenrect = get_world().screenrect
+    x = _get_random_coordinate(screenrect.width)
+    y = _get_random_coordinate(screenrect.height)
     return Point(x, y)
 
 
 class WorkerBee(Bee):
     team = 1
-    all_bees = []
+    all_bees = property(lambda self: self.world.bees, doc="Все пчелы мира")
 
     def is_other_bee_target(self, flower):
-        for bee in WorkerBee.all_bees:
-            if hasattr(bee, 'flower') and bee.flower and bee.flower._id == flower._id:
-                return True
-        return False
+        return self.is_claimed(flower)
 
     def get_nearest_flower(self):
-        flowers_with_honey = [flower for flower in self.flowers if flower.honey > 0]
-        if not flowers_with_honey:
-            return None
-        nearest_flower = None
-        for flower in flowers_with_honey:
-            if self.is_other_bee_target(flower):
-                continue
-            if nearest_flower is None or self.distance_to(flower) < self.distance_to(nearest_flower):
-                nearest_flower = flower
-        return nearest_flower
+        return self.scene.flowers_index.nearest(self.coord, predicate=lambda flower: not self.is_claimed(flower))
 
     def go_next_flower(self):
         if self.is_full():
             self.move_at(self.my_beehive)
         else:
             self.flower = self.get_nearest_flower()
+            self.claim(self.flower)
             if self.flower is not None:
                 self.move_at(self.flower)
             elif self.honey > 0:
                 self.move_at(self.my_beehive)
-            else:
+            elif self.flowers:
                 i = random_number(0, len(self.flowers) - 1)
                 self.move_at(self.flowers[i])
 
     def on_born(self):
-        WorkerBee.all_bees.append(self)
         self.go_next_flower()
 
     def on_stop_at_flower(self, flower):
@@ -794,26 +3753,19 @@ class GreedyBee(WorkerBee):
     team = 2
 
     def get_nearest_flower(self):
-        flowers_with_honey = [flower for flower in self.flowers if flower.honey > 0]
-        if not flowers_with_honey:
+        flowers_index = self.scene.flowers_index
+        if not flowers_index:
             return None
         nearest_flower = None
         max_honey = 0
-        for flower in flowers_with_honey:
-            distance = self.distance_to(flower)
-            if distance > 300:
-                continue
+        # in_radius отдает цветки по удалению, так что при равном мёде остается ближайший
+        for flower in flowers_index.in_radius(self.coord, 300):
             if flower.honey > max_honey:
                 nearest_flower = flower
                 max_honey = flower.honey
-            elif flower.honey == max_honey:
-                if nearest_flower is None:
-                    nearest_flower = flower
-                elif distance < self.distance_to(nearest_flower):
-                    nearest_flower = flower
         if nearest_flower:
             return nearest_flower
-        return random.choice(flowers_with_honey)
+        return self.world.random.choice(self.flowers_with_honey)
 
 if __name__ == '__main__':
 
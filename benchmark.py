@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Бенчмарки горячих мест движка и масштабирования сцены. Экран не нужен - используется dummy-драйвер SDL"""
+#   python benchmark.py --json results/2016-05-01.json
+#   python benchmark.py --quick --only tick,render --compare results/2016-05-01.json
+# Результаты (время на операцию, лучшее из нескольких замеров) печатаются таблицей и сохраняются в JSON,
+# чтобы следить за регрессиями от версии к версии
+
+import os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # до импорта pygame
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from timeit import default_timer
+
+import pygame
+
+import beegarden
+from my_bee import MyBee
+from beegarden import GameEngine, World, Scene, Point, Vector, HoneyHolder, Bee, WorkerBee, GreedyBee, random_point, \
+    SHARD_MIN_BEES
+
+FLOWERS = (10, 100, 1000, 10000)
+HONEY_BEES = (10, 100, 1000)
+# (цветков, пчел) - пчелы делятся поровну между WorkerBee и GreedyBee
+SCENES = ((10, 1), (100, 10), (1000, 100), (1000, 1000), (10000, 1000), (10000, 5000))
+QUICK_FLOWERS = (10, 100, 1000)
+QUICK_HONEY_BEES = (10, 100)
+QUICK_SCENES = ((10, 1), (100, 10), (1000, 100))
+SWARMS = (SHARD_MIN_BEES, 2 * SHARD_MIN_BEES)  # tick с --numpy: меньше SHARD_MIN_BEES пчел --shards не делит
+RESOLUTION = (1024, 768)
+BENCHMARKS = ('point', 'nearest', 'honey', 'place', 'tick', 'render', 'snapshot')
+
+
+def measure(func, min_time=0.2, repeat=3):
+    """
+    Время одного вызова func, секунд: число вызовов подбирается так, чтобы замер шел не меньше min_time,
+    из repeat замеров берется лучший
+    """
+    number = 1
+    while True:
+        start = default_timer()
+        for i in xrange(number):
+            func()
+        elapsed = default_timer() - start
+        if elapsed >= min_time / 10.0:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / elapsed))
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        for j in xrange(number):
+            func()
+        elapsed = (default_timer() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def measure_steps(make, steps, repeat=3, max_time=10.0):
+    """Время одного шага, секунд: лучший из repeat замеров по steps шагов заново созданной игры
+    (make() возвращает функцию шага). Замер дольше max_time обрывается, а следующие не делаются"""
+    best = None
+    for i in range(repeat):
+        step = make()
+        start = default_timer()
+        done = 0
+        while done < steps:
+            step()
+            done += 1
+            if default_timer() - start > max_time:
+                break
+        elapsed = default_timer() - start
+        if best is None or elapsed / done < best:
+            best = elapsed / done
+        if elapsed > max_time:
+            break
+    return best
+
+
+def make_game(flowers_count, bees_count, headless=True, use_numpy=False, seed=0, shards=1):
+    """Игра со сценой: flowers_count цветков, по половине пчел в каждой из двух команд"""
+    game = GameEngine("benchmark", resolution=RESOLUTION, headless=headless, use_numpy=use_numpy, seed=seed,
+                      shards=shards)
+    Scene(beehives_count=2, flowers_count=flowers_count, speed=5)
+    worker = type('WorkerBee', (WorkerBee,), {'team': 1})
+    greedy = type('GreedyBee', (GreedyBee,), {'team': 2})
+    for i in range(bees_count):
+        (worker if i % 2 == 0 else greedy)()
+    if not headless:
+        game.max_fps = 0  # кадры не ограничиваем
+    return game
+
+
+class SwarmBee(Bee):
+    """Пчела роя - летает между случайными точками: весь шаг уходит на движение, а не на поиск цветков"""
+
+    def on_born(self):
+        self.move_at(random_point())
+
+    def on_stop_at_target(self):
+        self.move_at(random_point())
+
+
+def make_swarm(bees_count, use_numpy=False, seed=0, shards=1):
+    """Игра без экрана с роем из bees_count пчел SwarmBee"""
+    game = GameEngine("benchmark", resolution=RESOLUTION, headless=True, use_numpy=use_numpy, seed=seed,
+                      shards=shards)
+    Scene(beehives_count=2, flowers_count=10, speed=5)
+    for i in range(bees_count):
+        SwarmBee()
+    return game
+
+
+def bench_point(options):
+    """Арифметика точек и векторов"""
+    point1, point2 = Point(100, 100), Point(400, 300)
+    vector = Vector(point1=point1, point2=point2, module=5)
+    cases = [
+        ('Point(x, y)', lambda: Point(100, 200)),
+        ('Point.add', lambda: point1.add(vector)),
+        ('Point.from_xy', lambda: Point.from_xy(100, 200)),
+        ('Point.distance_to', lambda: point1.distance_to(point2)),
+        ('Point.distance2_to', lambda: point1.distance2_to(point2)),
+        ('Point.near', lambda: point1.near(point2)),
+        ('Vector(point1, point2, module)', lambda: Vector(point1=point1, point2=point2, module=5)),
+        ('Vector.from_points', lambda: Vector.from_points(point1, point2, 5)),
+        ('Vector(direction, module)', lambda: Vector(direction=30, module=5)),
+        ('Vector.from_polar', lambda: Vector.from_polar(30, 5)),
+        ('Vector.angle', lambda: Vector.from_xy(3, 4).angle),
+        ('Vector.add', lambda: vector.add(vector)),
+        ('-Vector', lambda: -vector),
+    ]
+    for name, func in cases:
+        yield dict(op=name), measure(func, options.min_time)
+
+
+def bench_nearest(options):
+    """get_nearest_flower у WorkerBee и GreedyBee в зависимости от числа цветков"""
+    for flowers_count in options.flowers:
+        game = make_game(flowers_count, 2, use_numpy=options.numpy)
+        for bee in game.world.bees:
+            yield dict(bee=type(bee).__name__, flowers=flowers_count), \
+                measure(bee.get_nearest_flower, options.min_time)
+
+
+def bench_honey(options):
+    """Один шаг передачи мёда от цветка к пчеле и от пчелы к улью"""
+    game = make_game(10, 1, use_numpy=False)
+    bee = game.world.bees[0]
+    flower = game.world.flowers[0]
+    beehive = bee.my_beehive
+    infinite = 10 ** 12
+    bee._honey_max = flower._honey_max = beehive._honey_max = infinite
+
+    def loading():
+        flower._honey = infinite
+        HoneyHolder._update(bee)
+
+    def unloading():
+        bee._honey = infinite
+        HoneyHolder._update(bee)
+
+    bee.load_honey_from(flower)
+    yield dict(op='loading'), measure(loading, options.min_time)
+    bee._source = None
+    bee.unload_honey_to(beehive)
+    yield dict(op='unloading'), measure(unloading, options.min_time)
+
+    # шаг HoneyExchange: по 10 пчел на цветок сосут его одновременно
+    for bees_count in options.honey_bees:
+        game = make_game(max(bees_count // 10, 1), bees_count, use_numpy=options.numpy)
+        flowers = game.world.flowers
+        bees = game.world.bees
+        for flower in flowers:
+            flower._honey = flower._honey_max = infinite
+        for i, bee in enumerate(bees):
+            bee.stop()
+            bee._honey_max = infinite
+            bee.load_honey_from(flowers[i % len(flowers)])
+        yield dict(op='exchange', bees=bees_count), measure(game.world.honey_exchange.step, options.min_time)
+
+
+def bench_place(options):
+    """Создание сцены в новом мире - почти все время уходит на Scene._place_flowers"""
+    for flowers_count in options.flowers:
+        def place():
+            with World(resolution=RESOLUTION, headless=True):
+                Scene(beehives_count=2, flowers_count=flowers_count)
+
+        yield dict(flowers=flowers_count), measure(place, options.min_time, repeat=1)
+
+
+def bench_tick(options):
+    """Шаг симуляции без экрана - первые options.ticks шагов игры (с --numpy - и огромные рои SWARMS)"""
+    for flowers_count, bees_count in options.scenes:
+        def make():
+            return make_game(flowers_count, bees_count, use_numpy=options.numpy, shards=options.shards)._tick
+
+        yield dict(flowers=flowers_count, bees=bees_count), measure_steps(
+            make, options.ticks, options.repeat, options.max_time)
+    if options.numpy:  # одни и те же рои с разными --shards - сравнить через --compare
+        # сцена из десятков тысяч WorkerBee строится за квадратичное время (каждая ищет незаявленный цветок)
+        for bees_count in SWARMS:
+            def make():
+                return make_swarm(bees_count, use_numpy=options.numpy, shards=options.shards)._tick
+
+            yield dict(swarm=bees_count), measure_steps(make, options.ticks, options.repeat, options.max_time)
+
+
+def bench_render(options):
+    """Отрисованный кадр (шаг симуляции и отрисовка через dummy-драйвер SDL) - первые options.frames кадров"""
+    for flowers_count, bees_count in options.scenes:
+        def make():
+            game = make_game(flowers_count, bees_count, headless=False, use_numpy=options.numpy)
+            game._render()  # первый кадр запекает цветки и ульи в фон - его не считаем
+            return game._draw_scene
+
+        yield dict(flowers=flowers_count, bees=bees_count), measure_steps(
+            make, options.frames, options.repeat, options.max_time)
+
+
+def check_snapshot(use_numpy=False, ticks=200):
+    """Проверить, что игра после restore и в fork идет так же, как без них. Играет MyBee - он берет цветки
+    из world.flowers, так что список, который меняет код пчел, тоже должен вернуться"""
+    def make():
+        game = GameEngine("benchmark", resolution=RESOLUTION, headless=True, use_numpy=use_numpy, seed=0)
+        Scene(beehives_count=2, flowers_count=30, speed=5)
+        greedy = type('GreedyBee', (GreedyBee,), {'team': 2})
+        for i in range(5):
+            MyBee()
+            greedy()
+        for i in xrange(ticks):
+            game._tick()
+        return game
+
+    expected = make().simulate()
+    game = make()
+    world = game.world
+    snapshot = world.snapshot()
+    fork = world.fork()
+    game.simulate()
+    world.restore(snapshot)
+    restored = game.simulate()
+    with fork:
+        while not fork.is_finished() and fork.advance():
+            pass
+    for name, score in (('restore', restored), ('fork', fork.get_score())):
+        if score != expected:
+            raise Exception("check_snapshot: game after %s scored %s, not %s" % (name, score, expected))
+
+
+def bench_snapshot(options):
+    """Снимок мира, возврат к нему и копия мира (World.snapshot, restore, fork) - после options.ticks шагов"""
+    check_snapshot(options.numpy)
+    for flowers_count, bees_count in options.scenes:
+        game = make_game(flowers_count, bees_count, use_numpy=options.numpy)
+        for i in xrange(options.ticks):
+            game._tick()
+        world = game.world
+        snapshot = world.snapshot()
+        yield dict(op='snapshot', flowers=flowers_count, bees=bees_count), measure(world.snapshot, options.min_time)
+        yield dict(op='restore', flowers=flowers_count, bees=bees_count), \
+            measure(lambda: world.restore(snapshot), options.min_time)
+        yield dict(op='fork', flowers=flowers_count, bees=bees_count), measure(world.fork, options.min_time, repeat=1)
+
+
+def get_meta(options):
+    """Где и на чем мерили"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        commit=commit,
+        python=platform.python_version(),
+        pygame=pygame.version.ver,
+        numpy=beegarden.numpy.__version__ if beegarden.numpy is not None else None,
+        use_numpy=options.numpy,
+        shards=options.shards,
+        platform=platform.platform(),
+        video_driver=os.environ.get('SDL_VIDEODRIVER'),
+    )
+
+
+def run(options):
+    """Прогнать выбранные бенчмарки. Возвращает список результатов: имя, параметры, мкс на операцию"""
+    results = []
+    for name in options.only:
+        func = globals()['bench_' + name]
+        for params, seconds in func(options):
+            result = dict(benchmark=name, params=params, us=seconds * 1e6)
+            results.append(result)
+            print '%-8s %-50s %14.2f us' % (name, _params_text(params), result['us'])
+            sys.stdout.flush()
+    return results
+
+
+def _params_text(params):
+    return ' '.join('%s=%s' % item for item in sorted(params.items()))
+
+
+def _result_key(result):
+    return result['benchmark'], _params_text(result['params'])
+
+
+def compare(results, file_name):
+    """Сравнить с сохраненными результатами: во сколько раз стало медленнее (> 1) или быстрее (< 1)"""
+    with open(file_name) as old_file:
+        old = dict((_result_key(result), result) for result in json.load(old_file)['results'])
+    print
+    print 'compared with %s' % file_name
+    for result in results:
+        key = _result_key(result)
+        if key in old:
+            ratio = result['us'] / old[key]['us']
+            print '%-8s %-50s %14.2f us  x%.2f%s' % (key[0], key[1], result['us'], ratio,
+                                                    '  <-- slower' if ratio > 1.1 else '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарки движка beegarden")
+    parser.add_argument('--only', default=','.join(BENCHMARKS),
+                        help="какие бенчмарки гонять, через запятую: %s" % ', '.join(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help="только маленькие сцены")
+    parser.add_argument('--numpy', action='store_true', help="пакетный шаг пчел на numpy")
+    parser.add_argument('--shards', type=int, default=1, help="процессов на шаг пчел в tick (с --numpy)")
+    parser.add_argument('--min-time', type=float, default=0.2, help="секунд на один замер операции")
+    parser.add_argument('--ticks', type=int, default=100, help="шагов на замер tick")
+    parser.add_argument('--frames', type=int, default=50, help="кадров на замер render")
+    parser.add_argument('--repeat', type=int, default=3, help="замеров tick и render, берется лучший")
+    parser.add_argument('--max-time', type=float, default=10.0, help="предел секунд на один замер tick и render")
+    parser.add_argument('--json', default=None, help="куда сохранить результаты")
+    parser.add_argument('--compare', default=None, help="сравнить с ранее сохраненными результатами")
+    options = parser.parse_args()
+    options.only = [name.strip() for name in options.only.split(',') if name.strip()]
+    for name in options.only:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+    options.flowers = QUICK_FLOWERS if options.quick else FLOWERS
+    options.honey_bees = QUICK_HONEY_BEES if options.quick else HONEY_BEES
+    options.scenes = QUICK_SCENES if options.quick else SCENES
+
+    meta = get_meta(options)
+    results = run(options)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(dict(meta=meta, results=results), json_file, indent=2, sort_keys=True)
+    if options.compare:
+        compare(results, options.compare)
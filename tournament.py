@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Турнир пчел: каждый класс пчелы играет с каждым (round-robin) без экрана, матчи - на пуле процессов"""
+#   python tournament.py my_bee.MyBee beegarden.WorkerBee beegarden.GreedyBee --rounds 4
+# Каждый матч играется в своем мире и в свежем процессе (maxtasksperchild=1) - даже состояние,
+# которое код пчел держит в своих классах, между матчами не смешивается. --budget ограничивает время
+# обработчиков (CallbackBudget), --sandbox выполняет код каждой команды в своем процессе,
+# --watch показывает матчи по очереди в окне (LiveSimulation)
+
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import os
+import traceback
+
+from beegarden import GameEngine, Scene, Profiler, CallbackBudget, TelemetryRecorder, BUDGET_POLICIES
+
+
+def load_bee_class(name):
+    """Найти класс пчелы по имени вида 'модуль.Класс'"""
+    if not isinstance(name, basestring):
+        return name
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _team_class(bee_class, team):
+    """Класс пчелы, играющий за указанную команду"""
+    return type(bee_class.__name__, (bee_class,), {'team': team})
+
+
+def _make_game(match):
+    """Игра матча без экрана - пока только сцена"""
+    game = GameEngine("tournament", resolution=match['resolution'], headless=True,
+                      use_numpy=match['use_numpy'], seed=match['seed'], event_driven=match['event_driven'])
+    Scene(beehives_count=2, flowers_count=match['flowers_count'], speed=match['speed'])
+    return game
+
+
+def _add_bees(match):
+    """Пчелы обеих команд матча"""
+    for team, name in enumerate(match['bees'], 1):
+        bee_class = _team_class(load_bee_class(name), team)
+        for i in range(match['bees_count']):
+            bee_class()
+
+
+def setup_match(match):
+    """Игра матча без экрана со сценой и пчелами - для показа матча (GameEngine.watch)"""
+    game = _make_game(match)
+    _add_bees(match)
+    return game
+
+
+def play_match(match):
+    """Сыграть один матч без экрана. match - словарь из make_matches (команды, зерно, параметры сцены).
+    Возвращает словарь с мёдом каждой команды"""
+    # replay_dir, telemetry_dir - куда писать match-<номер>.replay и .telemetry, profile, budget_ms
+    # и sandbox - добавить в результат итоги Profiler.summary и CallbackBudget.summary
+    game = _make_game(match)
+    if match['profile']:
+        Profiler(game.world, keep_frames=False)
+    budget = None
+    if match['budget_ms'] is not None or match['sandbox']:
+        budget = CallbackBudget(game.world, budget_ms=match['budget_ms'], policy=match['budget_policy'],
+                                isolate=match['sandbox'])
+    replay = None
+    if match['replay_dir']:
+        replay = game.record_replay(os.path.join(match['replay_dir'], 'match-%d.replay' % match['match_id']))
+    telemetry = None
+    if match['telemetry_dir']:
+        telemetry = TelemetryRecorder(game.world, os.path.join(match['telemetry_dir'],
+                                                               'match-%d.telemetry' % match['match_id']))
+    try:
+        error = None
+        _add_bees(match)
+        score = game.simulate(max_ticks=match['max_ticks'])
+    except Exception:  # упавший код пчелы не должен ронять весь турнир - матч засчитывается как есть
+        error = traceback.format_exc()
+        score = game.world.get_score()
+    if replay is not None:
+        replay.close()
+    if telemetry is not None:
+        telemetry.close()
+    if budget is not None:
+        budget.close()
+    profile = game.profiler.summary() if game.profiler is not None else None
+    return dict(match_id=match['match_id'], bees=match['bees'], seed=match['seed'],
+                honey=(score[1], score[2]), ticks=game.ticks, error=error, profile=profile,
+                budget=budget.summary() if budget is not None else None)
+
+
+def make_matches(bee_names, rounds=1, seed=0, bees_count=10, flowers_count=80, speed=40,
+                 resolution=(1000, 500), max_ticks=20000, use_numpy=False, replay_dir=None,
+                 profile=False, event_driven=False, budget_ms=None, budget_policy='defer', sandbox=False,
+                 telemetry_dir=None):
+    """Расписание round-robin: каждая пара играет rounds раз, меняясь ульями каждый раунд"""
+    matches = []
+    for first, second in itertools.combinations(bee_names, 2):
+        for round_number in range(rounds):
+            bees = (first, second) if round_number % 2 == 0 else (second, first)
+            matches.append(dict(match_id=len(matches), bees=bees, seed=seed + len(matches),
+                                bees_count=bees_count, flowers_count=flowers_count, speed=speed,
+                                resolution=resolution, max_ticks=max_ticks, use_numpy=use_numpy,
+                                replay_dir=replay_dir, profile=profile, event_driven=event_driven,
+                                budget_ms=budget_ms, budget_policy=budget_policy, sandbox=sandbox,
+                                telemetry_dir=telemetry_dir))
+    return matches
+
+
+def run_tournament(bee_names, workers=None, **match_options):
+    """Сыграть турнир между классами пчел (имена вида 'модуль.Класс') на пуле из workers процессов.
+    Возвращает (результаты матчей, таблица по классам)"""
+    matches = make_matches(bee_names, **match_options)
+    if match_options.get('sandbox'):  # процессы пула не могут запускать свои процессы команд
+        results = [play_match(match) for match in matches]
+        return results, get_standings(bee_names, results)
+    pool = multiprocessing.Pool(processes=workers, maxtasksperchild=1)
+    try:
+        results = sorted(pool.imap_unordered(play_match, matches), key=lambda result: result['match_id'])
+    finally:
+        pool.close()
+        pool.join()
+    return results, get_standings(bee_names, results)
+
+
+def watch_tournament(bee_names, tick_rate=None, **match_options):
+    """Показать турнир в окне: матчи по очереди, каждый - в своем процессе (без повторов, телеметрии и бюджета).
+    tick_rate - шагов в секунду (None - как успевает процессор). Возвращает (результаты матчей, таблица)"""
+    results = []
+    for match in make_matches(bee_names, **match_options):
+        game = GameEngine("%s vs %s" % match['bees'], resolution=match['resolution'])
+        live = game.watch(setup_match, (match,), keep_open=False, tick_rate=tick_rate,
+                          max_ticks=match['max_ticks'])
+        if not live.finished:  # окно закрыли - турнир прерван
+            break
+        results.append(dict(match_id=match['match_id'], bees=match['bees'], seed=match['seed'],
+                            honey=(live.score.get(1, 0), live.score.get(2, 0)), ticks=live.ticks,
+                            error=live.error, profile=None, budget=None))
+    return results, get_standings(bee_names, results)
+
+
+def get_standings(bee_names, results):
+    """Таблица турнира: победы, поражения, ничьи и мёд - свой и соперников"""
+    standings = dict((name, dict(played=0, wins=0, losses=0, draws=0, honey=0, honey_against=0))
+                     for name in bee_names)
+    for result in results:
+        for side in (0, 1):
+            row = standings[result['bees'][side]]
+            own, other = result['honey'][side], result['honey'][1 - side]
+            row['played'] += 1
+            row['honey'] += own
+            row['honey_against'] += other
+            if own > other:
+                row['wins'] += 1
+            elif own < other:
+                row['losses'] += 1
+            else:
+                row['draws'] += 1
+    return standings
+
+
+def print_standings(standings):
+    rows = sorted(standings.items(), key=lambda item: (-item[1]['wins'], -item[1]['honey']))
+    print '%-30s %6s %5s %5s %5s %10s %10s' % ('bee', 'played', 'wins', 'loss', 'draw', 'honey', 'against')
+    for name, row in rows:
+        print '%-30s %6d %5d %5d %5d %10.0f %10.0f' % (name, row['played'], row['wins'], row['losses'],
+                                                      row['draws'], row['honey'], row['honey_against'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Round-robin турнир пчел без экрана")
+    parser.add_argument('bees', nargs='+', help="классы пчел: модуль.Класс")
+    parser.add_argument('--rounds', type=int, default=2, help="матчей на каждую пару")
+    parser.add_argument('--workers', type=int, default=None, help="процессов (по умолчанию - по числу ядер)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bees-count', type=int, default=10, help="пчел в команде")
+    parser.add_argument('--flowers', type=int, default=80)
+    parser.add_argument('--speed', type=int, default=40)
+    parser.add_argument('--max-ticks', type=int, default=20000)
+    parser.add_argument('--numpy', action='store_true', help="пакетный шаг пчел на numpy")
+    parser.add_argument('--events', action='store_true', help="перескакивать от события к событию вместо шагов")
+    parser.add_argument('--budget', type=float, default=None, help="мс на обработчики класса пчел за шаг")
+    parser.add_argument('--budget-policy', default='defer', choices=BUDGET_POLICIES,
+                        help="что делать при превышении бюджета: skip - событие после шага вне бюджета, "
+                             "defer - после шага в счет следующего, penalize - штраф мёдом")
+    parser.add_argument('--sandbox', action='store_true', help="код каждой команды - в своем процессе")
+    parser.add_argument('--replays', default=None, help="каталог для записи повторов матчей")
+    parser.add_argument('--telemetry', default=None, help="каталог для записи телеметрии матчей")
+    parser.add_argument('--profile', action='store_true', help="показать время движка и кода пчел по матчам")
+    parser.add_argument('--watch', type=float, default=None, metavar='TICK_RATE',
+                        help="показывать матчи в окне с такой скоростью, шагов в секунду (0 - как успевает игра)")
+    args = parser.parse_args()
+    for directory in (args.replays, args.telemetry):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    if args.watch is not None:
+        results, standings = watch_tournament(
+            args.bees, tick_rate=args.watch or None, rounds=args.rounds, seed=args.seed, bees_count=args.bees_count,
+            flowers_count=args.flowers, speed=args.speed, max_ticks=args.max_ticks, use_numpy=args.numpy,
+            event_driven=args.events)
+    else:
+        results, standings = run_tournament(
+            args.bees, workers=args.workers, rounds=args.rounds, seed=args.seed, bees_count=args.bees_count,
+            flowers_count=args.flowers, speed=args.speed, max_ticks=args.max_ticks, use_numpy=args.numpy,
+            replay_dir=args.replays, profile=args.profile, event_driven=args.events, budget_ms=args.budget,
+            budget_policy=args.budget_policy, sandbox=args.sandbox, telemetry_dir=args.telemetry)
+    for result in results:
+        print '#%-4d %s %.0f : %.0f %s (%d ticks)' % (result['match_id'], result['bees'][0], result['honey'][0],
+                                                      result['honey'][1], result['bees'][1], result['ticks'])
+        if result['profile']:
+            profile = result['profile']
+            print '      ticks %.0f ms, of them bee code: %s' % (
+                profile['phases']['tick']['total_ms'],
+                ', '.join('%s %.0f ms' % (row['cls'], row['total_ms']) for row in profile['classes']))
+        for row in result['budget'] or ():
+            if row['overruns'] or row['timeouts']:
+                print '      %s: over budget in %d ticks, skipped %d, deferred %d, penalty %.0f, timeouts %d' % (
+                    row['cls'], row['overruns'], row['skipped'], row['deferred'], row['penalty'], row['timeouts'])
+        if result['error']:
+            print result['error']
+    print
+    print_standings(standings)